@@ -0,0 +1,136 @@
+#
+# Compare the fit quality and time of the heuristic GPR hyperparameters with
+# the 10-restart MLE we use in processing.py, on synthetic thermals
+#
+# First this checks that predicting the grid in chunks, see predictGrid, gives
+# the same results as predicting it all at once.
+#
+# Usage:
+#
+# $ python3 benchmark_gpr.py
+#
+
+import numpy as np
+from time import perf_counter
+
+from identification.data import morePoints
+from identification.gpr import GPRParams, GPR, GPRtoThermal, \
+    heuristicGPRParams, evalMSE, fitGPR, predictGrid, predictionBounds, \
+    makeGrid
+
+#
+# A Gaussian-shaped thermal plus a circling path through part of it, with noise
+# added to the measurements like the vertical velocity from the autopilot
+#
+def syntheticThermal(random, samples=100, noise=0.2):
+    center = random.uniform(-30, 30, 2)
+    amplitude = random.uniform(2, 5)
+    sd = random.uniform(10, 30)
+    thermal = lambda x, y: amplitude*np.exp(
+            -((x-center[0])**2 + (y-center[1])**2)/(2*sd**2))
+
+    # A circle that drifts with the wind, somewhere near the thermal
+    angles = np.linspace(0, 4*np.pi, 24)
+    radius = random.uniform(20, 40)
+    drift = random.uniform(-1, 1, 2)
+    corners = np.vstack((radius*np.cos(angles) + drift[0]*angles,
+                         radius*np.sin(angles) + drift[1]*angles)).T
+    path = morePoints(corners, int(np.ceil(samples/len(corners))))[:samples]
+
+    measurements = thermal(path[:,0], path[:,1]) + \
+            random.normal(0, noise, len(path))
+    timepos = np.hstack((np.arange(len(path))[:,np.newaxis], path))
+
+    return timepos, measurements[:,np.newaxis], thermal, center
+
+#
+# Run one configuration on a synthetic thermal, returning the fit time, MSE of
+# the prediction over the grid, and how far off the thermal center was
+#
+def runConfiguration(gprParams, timepos, measurements, thermal, center,
+        extent=10, points=50):
+    start = perf_counter()
+    (grid, grid_x, grid_y), prediction, sigma = GPR(timepos, measurements,
+            gprParams, extent, points, eval_MSE=False)
+    x, y, _, _ = GPRtoThermal(grid, prediction, sigma)
+    duration = perf_counter() - start
+
+    mse = evalMSE(prediction, thermal(grid[:,0], grid[:,1]))
+    distance = np.linalg.norm(np.subtract((x, y), center))
+
+    return duration, mse, distance
+
+#
+# Check that predictGrid gives the same mean and MSE whether it predicts the
+# grid in chunks on one thread or several, with one gp.predict call for the
+# whole grid, or with scikit-learn's own batch_size. The chunk size doesn't
+# divide the number of grid points so the last chunk is a partial one.
+#
+# Raises an AssertionError if any of them differ.
+#
+def checkPredictGrid(random, points=100, chunkSize=999, threads=4):
+    timepos, measurements, _, _ = syntheticThermal(random)
+    path = timepos[:,1:]
+    gp = fitGPR(path, measurements, heuristicGPRParams(timepos, measurements))
+    grid, _, _ = makeGrid(predictionBounds(path, 10), points)
+
+    expected, expectedMSE = gp.predict(grid, eval_MSE=True)
+    results = {
+        "batch_size": gp.predict(grid, eval_MSE=True, batch_size=chunkSize),
+    }
+
+    for t in [None, threads]:
+        results["chunks, threads=%s" % t] = predictGrid(gp, grid,
+                eval_MSE=True, chunkSize=chunkSize, threads=t)
+        results["chunks, threads=%s, no MSE" % t] = (predictGrid(gp, grid,
+                eval_MSE=False, chunkSize=chunkSize, threads=t), None)
+
+    for name, (prediction, MSE) in results.items():
+        assert prediction.shape == expected.shape, name
+        np.testing.assert_allclose(prediction, expected, err_msg=name)
+
+        if MSE is not None:
+            assert MSE.shape == expectedMSE.shape, name
+            np.testing.assert_allclose(MSE, expectedMSE, err_msg=name)
+
+if __name__ == "__main__":
+    checkPredictGrid(np.random.RandomState(1))
+    print("predictGrid matches predicting the whole grid at once")
+
+    trials = 20
+    random = np.random.RandomState(0)
+
+    configurations = {
+        "MLE, 10 restarts": lambda timepos, measurements: GPRParams(
+            theta0=1e-2, thetaL=1e-10, thetaU=1e10, nugget=1, random_start=10),
+        "Heuristic, no MLE": lambda timepos, measurements: heuristicGPRParams(
+            timepos, measurements),
+        "Heuristic, 1 MLE": lambda timepos, measurements: heuristicGPRParams(
+            timepos, measurements, mle=True),
+    }
+
+    results = dict((name, []) for name in configurations)
+
+    for i in range(trials):
+        timepos, measurements, thermal, center = syntheticThermal(random)
+
+        for name, params in configurations.items():
+            try:
+                results[name].append(runConfiguration(
+                    params(timepos, measurements), timepos, measurements,
+                    thermal, center))
+            except ValueError:
+                print("Error: ValueError, couldn't run GPR for", name)
+
+    print("%-20s %12s %12s %12s %12s" % ("Configuration", "Time [ms]",
+        "MSE", "Center [m]", "Failures"))
+
+    for name, r in results.items():
+        if not r:
+            print("%-20s %12s %12s %12s %12d" % (name, "-", "-", "-", trials))
+            continue
+
+        r = np.array(r)
+        print("%-20s %12.1f %12.4f %12.2f %12d" % (name,
+            np.median(r[:,0])*1e3, np.median(r[:,1]), np.median(r[:,2]),
+            trials-len(r)))
@@ -0,0 +1,191 @@
+#
+# Build a catalog of the thermals in a whole directory of recorded logs
+#
+# Each CSV log is converted into a memory-mapped cache (see loadConvertedLog)
+# a chunk at a time and split into sliding windows, and every thermal GPR is
+# confident in (see ThermalsGPR) is added to one catalog CSV file. Only one
+# window of a log is ever copied into memory, so a worker's memory doesn't
+# grow with the size of the log. The logs are processed in parallel, each
+# worker process only handling one log before being replaced, so nothing is
+# held on to from one log to the next.
+#
+# The run can be interrupted and started again: each log is listed in the
+# resume index (the catalog filename plus .index) after its thermals are
+# written, and logs already in the index are skipped if they haven't changed.
+#
+# Usage, e.g.:
+#
+# $ python3 catalog.py ../logs -o thermals.csv
+#
+
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+
+from identification.data import timeWindowBounds, xyToLatLong
+from identification.gpr import GPRParams, ThermalsGPR
+from identification.cache import logKey, loadConvertedLog
+
+catalogColumns = ['file', 'window', 'start', 'end', 'x', 'y', 'lat', 'lon',
+        'strength', 'uncertainty']
+
+#
+# All the CSV files in the directory and its subdirectories, sorted so the
+# catalog is in the same order every time
+#
+def findLogs(directory):
+    return sorted(os.path.join(root, name)
+            for root, dirs, files in os.walk(directory)
+            for name in files if name.lower().endswith('.csv'))
+
+#
+# The logs in the resume index, filename -> logKey when it was processed
+#
+def readIndex(indexFile):
+    done = {}
+
+    if os.path.exists(indexFile):
+        with open(indexFile) as f:
+            for line in f:
+                entry = json.loads(line)
+                done[entry['file']] = entry['key']
+
+    return done
+
+#
+# Find all the thermals in one log, run in a worker process
+#
+# Returns a list of catalog rows.
+#
+def catalogLog(filename, slidingWindow, slideBy, sampleInterval, points,
+        gprParams, cacheDir='.cache', chunksize=100000):
+    # Every row is kept, memory mapped rather than read into memory
+    log = loadConvertedLog(filename, cacheDir, chunksize=chunksize)
+    times = log['time']
+    rows = []
+
+    if not len(times):
+        return rows
+
+    slidingWindows = int((times[-1] - times[0] - slidingWindow)//slideBy) + 1
+
+    for i in range(max(slidingWindows, 0)):
+        start = times[0] + slideBy*i
+        begin, end = timeWindowBounds(times, start, slidingWindow)
+
+        # Only this window is copied out of the log
+        window, lat_0 = log.dataFrame(begin, end-begin,
+                interval=sampleInterval)
+        measurements = np.array(window[['VelDown']])
+        timepos = np.array(window[['time', 'x', 'y']])
+
+        try:
+            thermals = ThermalsGPR(timepos, measurements, gprParams, extent=0,
+                    points=points)
+        except ValueError:
+            print("Error: ValueError, couldn't run GPR for", filename,
+                    "window", i)
+            continue
+
+        for x, y, prediction, uncertainty in thermals:
+            lat, lon = xyToLatLong(x, y, lat_0)
+            rows.append([filename, i, start, start+slidingWindow, x, y, lat,
+                lon, float(np.ravel(prediction)[0]),
+                float(np.ravel(uncertainty)[0])])
+
+    return rows
+
+#
+# Run catalogLog on the arguments, returning the filename, its rows, and the
+# error message if it failed, so one bad log doesn't stop the whole pool
+#
+def catalogTask(args):
+    filename = args[0]
+
+    try:
+        return filename, catalogLog(*args), None
+    except Exception as e:
+        return filename, None, str(e)
+
+#
+# Catalog all the logs in directory into the output CSV file, skipping the
+# ones already done according to the resume index
+#
+# Returns how many logs were processed this time.
+#
+def buildCatalog(directory, output, slidingWindow=45, slideBy=15,
+        sampleInterval=0.4, points=100, gprParams=None, maxWorkers=None,
+        cacheDir='.cache'):
+    if gprParams is None:
+        gprParams = GPRParams(theta0=1e-2, thetaL=1e-10, thetaU=1e10,
+                nugget=1, random_start=10)
+
+    indexFile = output + '.index'
+    done = readIndex(indexFile)
+
+    # Drop rows of a log that was being written when we were interrupted,
+    # i.e. that didn't make it into the index, or that has changed since
+    if os.path.exists(output):
+        catalog = pd.read_csv(output)
+        keep = catalog['file'].isin([f for f in done
+            if os.path.exists(f) and logKey(f) == done[f]])
+
+        if not keep.all():
+            catalog[keep].to_csv(output, index=False)
+
+    # Not the catalog itself if it's saved in the same directory
+    todo = [f for f in findLogs(directory) if done.get(f) != logKey(f)
+            and os.path.abspath(f) != os.path.abspath(output)]
+
+    if not os.path.exists(output):
+        pd.DataFrame(columns=catalogColumns).to_csv(output, index=False)
+
+    # A new worker for each log so its memory is freed when it's done
+    tasks = [(f, slidingWindow, slideBy, sampleInterval, points, gprParams,
+        cacheDir) for f in todo]
+
+    with Pool(processes=maxWorkers, maxtasksperchild=1) as pool:
+        for filename, rows, error in pool.imap_unordered(catalogTask, tasks):
+            if error is not None:
+                # Not added to the index, so it's tried again next time
+                print("Error: couldn't process", filename, "-", error)
+                continue
+
+            pd.DataFrame(rows, columns=catalogColumns).to_csv(output,
+                    mode='a', header=False, index=False)
+
+            with open(indexFile, 'a') as f:
+                f.write(json.dumps({'file': filename,
+                    'key': logKey(filename)}) + '\n')
+
+            print("Found", len(rows), "thermals in", filename)
+
+    return len(todo)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', help="directory of simulator CSV logs")
+    parser.add_argument('-o', '--output', default='catalog.csv',
+        help="CSV file to save the catalog in")
+    parser.add_argument('--window', type=float, default=45,
+        help="sliding window length in seconds")
+    parser.add_argument('--slide', type=float, default=15,
+        help="seconds to slide each window by")
+    parser.add_argument('--interval', type=float, default=0.4,
+        help="seconds between the samples used in each window")
+    parser.add_argument('--points', type=int, default=100,
+        help="grid points along each axis")
+    parser.add_argument('--workers', type=int, default=None,
+        help="number of processes, default is one per core")
+    parser.add_argument('--cache', default='.cache',
+        help="directory to save the converted logs in")
+    args = parser.parse_args()
+
+    processed = buildCatalog(args.directory, args.output, args.window,
+            args.slide, args.interval, args.points, maxWorkers=args.workers,
+            cacheDir=args.cache)
+
+    print("Processed", processed, "logs, catalog saved to", args.output)
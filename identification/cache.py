@@ -0,0 +1,135 @@
+#
+# Cache flight logs after converting them with readData, so we don't have to
+# parse the CSV file and convert Lat-Long to X-Y every time
+#
+# Each log is saved as one .npy file per column, which are memory mapped when
+# loaded, so loading is instant and windows of the log are views into the
+# files rather than copies.
+#
+
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+from identification.data import averageLatitude, convertedChunks, \
+    finishData, decimateTimes
+
+# The columns readData outputs that we save
+logColumns = ['time', 'x', 'y', 'VelDown', 'Latitude', 'Longitude']
+
+#
+# Key identifying this version of the log file, from its path, size, and
+# modification time, or if hashContents, from its contents
+#
+def logKey(filename, hashContents=False):
+    h = hashlib.sha1()
+
+    if hashContents:
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    else:
+        stat = os.stat(filename)
+        h.update(os.path.abspath(filename).encode('utf-8'))
+        h.update(str((stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+
+    return h.hexdigest()
+
+#
+# A converted log, with each column a read-only memory-mapped array
+#
+class ConvertedLog:
+    def __init__(self, directory, lat_0, filename):
+        self.directory = directory
+        self.lat_0 = lat_0
+        self.filename = filename
+        self.columns = dict((name, np.load(os.path.join(directory, name + '.npy'),
+            mmap_mode='r')) for name in logColumns)
+
+    # When sent to another process, just send where the files are and map
+    # them again there rather than copying all the columns
+    def __reduce__(self):
+        return (ConvertedLog, (self.directory, self.lat_0, self.filename))
+
+    def __len__(self):
+        return len(self.columns['time'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    # Views of the columns for samples start to start+size, taking every
+    # step'th sample, without copying
+    def window(self, start, size, step=1):
+        return dict((name, column[start:start+size:step])
+                for name, column in self.columns.items())
+
+    # Like readData on the raw data for samples start to start+size, but
+    # without converting again. This copies just this window into a DataFrame.
+    #
+    # With an interval, this takes about one sample every interval seconds
+    # rather than every step'th sample, see decimateTimes.
+    #
+    # Note that X-Y is relative to the lat_0 of the whole log rather than of
+    # this window.
+    def dataFrame(self, start=0, size=None, step=1, startAtZero=False,
+            normalize=False, interval=None):
+        if size is None:
+            size = len(self) - start
+
+        if interval is not None:
+            window = self.window(start, size)
+            index = start + decimateTimes(window['time'], interval)
+            data = pd.DataFrame(dict((name, column[index - start])
+                for name, column in window.items()), columns=logColumns,
+                index=index)
+        else:
+            data = pd.DataFrame(self.window(start, size, step),
+                    columns=logColumns,
+                    index=np.arange(start, min(start+size, len(self)), step),
+                    copy=True)
+
+        return finishData(data, startAtZero, normalize), self.lat_0
+
+#
+# Load the converted log for this CSV file, converting it and saving it in
+# cacheDir the first time
+#
+def loadConvertedLog(filename, cacheDir='.cache', hashContents=False,
+        chunksize=100000):
+    directory = os.path.join(cacheDir, logKey(filename, hashContents))
+    metaFile = os.path.join(directory, 'meta.json')
+
+    if not os.path.exists(metaFile):
+        os.makedirs(directory, exist_ok=True)
+
+        # Keep every row so sample numbers match the CSV file. Each converted
+        # chunk is written straight into the files, so only one chunk is in
+        # memory at a time however big the log is.
+        lat_0, rows = averageLatitude(filename, chunksize)
+        columns = dict((name, np.lib.format.open_memmap(
+            os.path.join(directory, name + '.npy'), mode='w+',
+            dtype=np.float64, shape=(rows,))) for name in logColumns)
+        start = 0
+
+        for chunk in convertedChunks(filename, lat_0, chunksize):
+            for name, column in columns.items():
+                column[start:start+len(chunk)] = chunk[name].values
+
+            start += len(chunk)
+
+        for column in columns.values():
+            column.flush()
+
+        del columns
+
+        # Written last, so if we're interrupted it'll be converted again
+        with open(metaFile, 'w') as f:
+            json.dump({'filename': os.path.abspath(filename), 'lat_0': lat_0,
+                'rows': rows}, f)
+
+    with open(metaFile) as f:
+        meta = json.load(f)
+
+    return ConvertedLog(directory, meta['lat_0'], meta['filename'])
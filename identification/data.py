@@ -28,32 +28,42 @@ def boundsFromPath(path):
 # in between every set of two points linearly
 #
 def morePoints(path, num):
-    newPath = []
+    path = np.asarray(path, dtype=float)
 
-    # Add points between each pair
-    for i in range(1, len(path)):
-        prev = path[i-1]
-        cur  = path[i]
+    if len(path) < 2:
+        return path
 
-        # Add the first point
-        newPath.append(prev)
+    # Go the right proportion along each segment at once, starting with the
+    # first point of the segment
+    prev = path[:-1]
+    towardCurrent = path[1:] - prev
+    proportion = np.arange(num+1)/(num+1)
+    newPath = prev[:,np.newaxis,:] + \
+        proportion[np.newaxis,:,np.newaxis]*towardCurrent[:,np.newaxis,:]
 
-        # Calculate the vector toward the next point
-        towardCurrent = np.subtract(cur, prev)
-        distance = np.linalg.norm(towardCurrent)
-        towardCurrentNorm = towardCurrent / np.linalg.norm(towardCurrent)
-        eachStep = distance/(num+1)
+    # Append the last point as well
+    return np.vstack((newPath.reshape(-1, path.shape[1]), path[-1:]))
 
-        # Go the right proportion along it the right number of times
-        # to insert the specified number of points between
-        for j in range(0, num):
-            newPosition = prev + (j+1)*eachStep*towardCurrentNorm
-            newPath.append(tuple(newPosition))
+#
+# Take a list of points and resample it to points every spacing meters along
+# the path, including the first and last points
+#
+def resamplePath(path, spacing):
+    path = np.asarray(path, dtype=float)
 
-    # Append the last point as well
-    newPath.append(path[-1])
+    # Distance along the path to each point, skipping repeated points
+    distance = np.concatenate(([0], np.cumsum(
+        np.sqrt(np.sum(np.diff(path, axis=0)**2, axis=1)))))
+    keep = np.concatenate(([True], np.diff(distance) > 0))
+    path, distance = path[keep], distance[keep]
+
+    targets = np.arange(0, distance[-1], spacing)
 
-    return np.array(newPath)
+    if len(targets) == 0 or targets[-1] < distance[-1]:
+        targets = np.append(targets, distance[-1])
+
+    return np.vstack([np.interp(targets, distance, path[:,i])
+        for i in range(path.shape[1])]).T
 
 #
 # Convert from lat-long to x-y
@@ -79,79 +89,491 @@ def xyToLatLong(x, y, lat_0):
 
     return lat, long
 
+#
+# A fixed local X-Y frame with its origin at (lat_0, lon_0)
+#
+# Unlike latLongToXY, where lat_0 changes with each window, this keeps the same
+# origin, so positions converted once stay valid for every later fit. The trig
+# for the origin is computed once rather than on every call, and all the
+# conversions work on whole arrays at a time.
+#
+# Enu - rather than the equirectangular approximation, use the local
+#     east-north-up frame on the WGS84 ellipsoid, which is more accurate far
+#     from the origin. Then x is east and y is north, both in meters.
+# Degrees - whether latitudes and longitudes are in degrees rather than
+#     radians (the network data is in radians)
+#
+class LocalFrame:
+    # WGS84 ellipsoid
+    a = 6378137.0 # m
+    f = 1/298.257223563
+    e2 = f*(2-f)
+
+    def __init__(self, lat_0, lon_0=0.0, alt_0=0.0, enu=False, degrees=False):
+        self.lat_0 = lat_0
+        self.lon_0 = lon_0
+        self.alt_0 = alt_0
+        self.enu = enu
+        self.degrees = degrees
+
+        # Equirectangular
+        self.r = 6.371e6 # m
+        self.cos_lat_0 = np.cos(self.radians(lat_0))
+
+        # East-north-up
+        lat, lon = self.radians(lat_0), self.radians(lon_0)
+        self.origin = self.toECEF(lat, lon, alt_0)
+        self.rotation = np.array([
+            [-np.sin(lon), np.cos(lon), 0],
+            [-np.sin(lat)*np.cos(lon), -np.sin(lat)*np.sin(lon), np.cos(lat)],
+            [np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)]])
+
+    def radians(self, angle):
+        if self.degrees:
+            return np.radians(angle)
+
+        return angle
+
+    def fromRadians(self, angle):
+        if self.degrees:
+            return np.degrees(angle)
+
+        return angle
+
+    # Geodetic to Earth-centered Earth-fixed, in radians
+    def toECEF(self, lat, lon, alt):
+        N = self.a/np.sqrt(1 - self.e2*np.sin(lat)**2)
+        return np.array([(N + alt)*np.cos(lat)*np.cos(lon),
+                         (N + alt)*np.cos(lat)*np.sin(lon),
+                         (N*(1 - self.e2) + alt)*np.sin(lat)])
+
+    # Earth-centered Earth-fixed to geodetic, in radians
+    def fromECEF(self, X, Y, Z):
+        lon = np.arctan2(Y, X)
+        p = np.hypot(X, Y)
+        lat = np.arctan2(Z, p*(1 - self.e2))
+
+        # Converges to well under a millimeter in a few iterations
+        for i in range(5):
+            N = self.a/np.sqrt(1 - self.e2*np.sin(lat)**2)
+            alt = p/np.cos(lat) - N
+            lat = np.arctan2(Z, p*(1 - self.e2*N/(N + alt)))
+
+        return lat, lon, alt
+
+    # Convert from lat-long to x-y in this frame, if ENU at altitude alt
+    # (default is the origin's altitude)
+    def toXY(self, lat, long, alt=None):
+        lat = np.asarray(lat, dtype=float)
+        long = np.asarray(long, dtype=float)
+
+        if not self.enu:
+            x = self.r*(self.radians(long) - self.radians(self.lon_0))*self.cos_lat_0
+            y = self.r*(self.radians(lat) - self.radians(self.lat_0))
+            return x, y
+
+        if alt is None:
+            alt = self.alt_0
+
+        ecef = self.toECEF(self.radians(lat), self.radians(long), alt)
+        d = ecef - self.origin.reshape((3,) + (1,)*(ecef.ndim-1))
+        east, north, up = np.tensordot(self.rotation, d, axes=1)
+
+        return east, north
+
+    # Convert from x-y in this frame to lat-long, if ENU at up meters above
+    # the origin
+    def toLatLong(self, x, y, up=0.0):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+
+        if not self.enu:
+            lat = self.radians(self.lat_0) + y/self.r
+            long = self.radians(self.lon_0) + x/self.r/self.cos_lat_0
+            return self.fromRadians(lat), self.fromRadians(long)
+
+        enu = np.array(np.broadcast_arrays(x, y, up))
+        ecef = np.tensordot(self.rotation.T, enu, axes=1) + \
+            self.origin.reshape((3,) + (1,)*(enu.ndim-1))
+        lat, long, alt = self.fromECEF(*ecef)
+
+        return self.fromRadians(lat), self.fromRadians(long)
+
+# Columns of the simulator CSV files that we use and their types
+dataColumns = {
+    'SystemTime': np.float64,
+    'Latitude': np.float64,
+    'Longitude': np.float64,
+    'VelDown': np.float64,
+}
+
+#
+# Convert the simulator data to time and X-Y, all rows at once
+#
+def convertData(df, lat_0):
+    lat = df['Latitude'].values #*np.pi/180
+    long = df['Longitude'].values #*np.pi/180
+    x, y = latLongToXY(lat, long, lat_0)
+
+    return pd.DataFrame({
+            'time': df['SystemTime'].values*1e-3, # s
+            'x': x,
+            'y': y,
+            'VelDown': df['VelDown'].values,
+            'Latitude': lat,
+            'Longitude': long,
+        }, index=df.index, columns=['time', 'x', 'y', 'VelDown',
+                                    'Latitude', 'Longitude'])
+
+#
+# Merge samples that are within about tolerance meters of each other, averaging
+# each of the columns (a dictionary of equal-length arrays) over the samples
+# that are merged, except the time column, which is the latest of them
+#
+# This hashes each position to a tolerance-sized grid cell, so it's done all
+# at once rather than comparing every pair of samples. Two samples closer than
+# the tolerance but on opposite sides of a cell boundary aren't merged, but
+# every merged group is within one cell.
+#
+# The groups are in the order of their last sample, so when circling back
+# over a cell visited a while ago, the merged sample counts as recent, e.g.
+# when taking the last so many samples.
+#
+# Returns the merged columns and the index of the last sample of each group.
+#
+def mergeNearby(columns, tolerance, x='x', y='y', time='time'):
+    cells = np.floor(np.vstack((columns[x], columns[y])).T/tolerance
+            ).astype(np.int64)
+    _, inverse, counts = np.unique(cells, axis=0, return_inverse=True,
+            return_counts=True)
+    inverse = inverse.reshape(-1)
+
+    last = np.zeros(len(counts), dtype=np.int64)
+    np.maximum.at(last, inverse, np.arange(len(inverse)))
+
+    # Number the groups by when they last appear rather than by cell
+    order = np.argsort(last)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    group = rank[inverse]
+    counts = counts[order]
+
+    merged = {}
+
+    for name, column in columns.items():
+        column = np.asarray(column, dtype=float)
+
+        if name == time:
+            latest = np.full(len(counts), -np.inf)
+            np.maximum.at(latest, group, column)
+            merged[name] = latest
+        else:
+            merged[name] = np.bincount(group, weights=column,
+                    minlength=len(counts))/counts
+
+    return merged, last[order]
+
+#
+# Shrink the range of X-Y values if desired and remove duplicates, see readData
+#
+# If tolerance is given, samples within about that many meters of each other
+# are merged rather than only dropping exact duplicates, see mergeNearby.
+#
+def finishData(data, startAtZero=False, normalize=False, dropDuplicates=True,
+        tolerance=None):
+    # Try to shrink the range of X-Y values if desired
+    if startAtZero:
+        data['x'] -= data['x'].iloc[0]
+        data['y'] -= data['y'].iloc[0]
+    elif normalize:
+        minX, maxX = np.min(data['x']), np.max(data['x'])
+        minY, maxY = np.min(data['y']), np.max(data['y'])
+        data['x'] = (data['x'] - minX)/(maxX-minX)
+        data['y'] = (data['y'] - minY)/(maxY-minY)
+
+    # For GPR (time,x,y) must be unique
+    if dropDuplicates and tolerance:
+        columns, last = mergeNearby(dict((name, data[name].values)
+            for name in data.columns), tolerance)
+        data = pd.DataFrame(columns, index=data.index[last],
+                columns=data.columns)
+    elif dropDuplicates:
+        #data = data.drop_duplicates(subset=['time','x','y'])
+        data = data.drop_duplicates(subset=['x','y'])
+
+    return data
+
 #
 # Read the data from the simulator
 #
 # If you don't care about actual X-Y position, you can use either
 # startAtZero to set the first position as the zero point or use
-# normalize to make the X-Y values all be between 0 and 1.
+# normalize to make the X-Y values all be between 0 and 1. Set tolerance to
+# also merge samples within that many meters, see finishData.
 #
-def readData(df, startAtZero=False, normalize=False):
-    data = pd.DataFrame()
-
+def readData(df, startAtZero=False, normalize=False, tolerance=None):
     # Average all the latitudes to use as the center of our map
-    lat_0 = np.average(df[['Latitude']]) #*np.pi/180
+    lat_0 = np.average(df['Latitude']) #*np.pi/180
 
     # Get the data we care about and convert Lat-Long to X-Y
-    #for index, row in df[['Latitude','Longitude','VelDown']].iterrows():
-    for index, row in df.iterrows():
-        time = row['SystemTime']*1e-3 # s
-        lat = row['Latitude'] #*np.pi/180
-        long = row['Longitude'] #*np.pi/180
-        vel = row['VelDown']
+    data = convertData(df, lat_0)
+
+    return finishData(data, startAtZero, normalize,
+            tolerance=tolerance), lat_0
+
+#
+# Average latitude of a simulator CSV file, reading only that column a chunk
+# of rows at a time
+#
+# Returns the average and the number of rows.
+#
+def averageLatitude(filename, chunksize=100000):
+    total = 0
+    count = 0
+
+    for chunk in pd.read_csv(filename, usecols=['Latitude'],
+            dtype={'Latitude': dataColumns['Latitude']},
+            chunksize=chunksize):
+        total += chunk['Latitude'].sum()
+        count += len(chunk)
+
+    return total/count, count
+
+#
+# Convert a simulator CSV file like readData, yielding one converted chunk of
+# rows at a time, so only one chunk is ever in memory. Every row is kept,
+# since duplicates can't be found without seeing the whole file.
+#
+def convertedChunks(filename, lat_0, chunksize=100000):
+    for chunk in pd.read_csv(filename, usecols=list(dataColumns),
+            dtype=dataColumns, chunksize=chunksize):
+        yield convertData(chunk, lat_0)
+
+#
+# Read the data from a simulator CSV file, like readData but only reading the
+# columns we need, a chunk of rows at a time, so the raw file never has to fit
+# in memory. The converted data is all returned at once, so to convert a log
+# bigger than memory, use convertedChunks, e.g. like loadConvertedLog.
+#
+# If lat_0 isn't given, this first reads just the latitudes to average them.
+# Set dropDuplicates=False to keep every row, e.g. so windows of a certain
+# number of samples line up with the original file.
+#
+def readDataChunked(filename, startAtZero=False, normalize=False,
+        chunksize=100000, lat_0=None, dropDuplicates=True, tolerance=None):
+    if lat_0 is None:
+        lat_0, rows = averageLatitude(filename, chunksize)
+
+    data = pd.concat(convertedChunks(filename, lat_0, chunksize))
+
+    return finishData(data, startAtZero, normalize, dropDuplicates,
+            tolerance), lat_0
+
+#
+# Reject bad telemetry samples all at once before they get to GPR
+#
+# Each sample is rejected for the first of these that applies, and the number
+# rejected for each reason in the last call to keep() is in rejected:
+#
+#  - nonfinite: NaN or inf time, position, or energy
+#  - noFix: latitude and longitude both zero, i.e. before the GPS has a fix
+#  - altitude: altitude outside minAlt to maxAlt meters, if given. Samples
+#    without an altitude aren't rejected for this.
+#  - repeatedTime: not after every earlier sample, i.e. a repeated message
+#  - speed: a GPS glitch, where getting to this sample from the previous one
+#    and from this sample to the next one would both take flying faster than
+#    maxSpeed m/s. This catches samples that jump away and back rather than
+#    a whole glitched segment, which is what we see from the autopilot. The
+#    first and last samples only have one neighbor, so they're compared with
+#    the sample two away instead, so a glitch next to them doesn't reject them.
+#
+# Latitudes and longitudes are in the same units as for latLongToXY.
+#
+class TelemetryCleaner:
+    reasons = ['nonfinite', 'noFix', 'altitude', 'repeatedTime', 'speed']
+
+    def __init__(self, maxSpeed=50.0, minAlt=None, maxAlt=None):
+        self.maxSpeed = maxSpeed
+        self.minAlt = minAlt
+        self.maxAlt = maxAlt
+        self.rejected = dict.fromkeys(self.reasons, 0)
+
+    # Boolean mask of the samples to keep, given a dictionary of 'time',
+    # 'lat', 'long', 'energy', and optionally 'alt' arrays
+    def keep(self, columns):
+        time = np.asarray(columns['time'], dtype=float)
+        lat = np.asarray(columns['lat'], dtype=float)
+        long = np.asarray(columns['long'], dtype=float)
+        energy = np.asarray(columns['energy'], dtype=float)
+        alt = columns.get('alt')
+
+        keep = np.ones(len(time), dtype=bool)
+        self.rejected = dict.fromkeys(self.reasons, 0)
+
+        def reject(reason, bad):
+            bad = bad & keep
+            self.rejected[reason] += int(np.count_nonzero(bad))
+            keep[bad] = False
+
+        reject('nonfinite', ~(np.isfinite(time) & np.isfinite(lat) &
+            np.isfinite(long) & np.isfinite(energy)))
+        reject('noFix', (lat == 0) & (long == 0))
+
+        if alt is not None:
+            alt = np.asarray(alt, dtype=float)
+
+            with np.errstate(invalid='ignore'):
+                if self.minAlt is not None:
+                    reject('altitude', alt < self.minAlt)
+                if self.maxAlt is not None:
+                    reject('altitude', alt > self.maxAlt)
+
+        # Latest time of all the samples before each one
+        latest = np.maximum.accumulate(np.where(keep, time, -np.inf))
+        reject('repeatedTime', time <= np.concatenate(([-np.inf], latest[:-1])))
+
+        index = np.flatnonzero(keep)
+
+        if len(index) > 2:
+            x, y = latLongToXY(lat[index], long[index], lat[index[0]])
+            t = time[index]
+
+            with np.errstate(divide='ignore'):
+                # To the next sample and to the one after that
+                speed = np.hypot(np.diff(x), np.diff(y))/np.diff(t)
+                skip = np.hypot(x[2:] - x[:-2], y[2:] - y[:-2])/(t[2:] - t[:-2])
+
+            fast = speed > self.maxSpeed
+            fastSkip = skip > self.maxSpeed
+            into = np.concatenate(([fastSkip[0]], fast))
+            outOf = np.concatenate((fast, [fastSkip[-1]]))
+
+            glitch = np.zeros(len(time), dtype=bool)
+            glitch[index] = into & outOf
+            reject('speed', glitch)
+
+        return keep
+
+#
+# Indices of the first of each unique row, in their original order, like
+# DataFrame.drop_duplicates() keeps
+#
+def uniqueRows(a):
+    _, first = np.unique(a, axis=0, return_index=True)
+    return np.sort(first)
+
+#
+# Convert a deque of objects from the network into columns, done all at once
+# rather than row by row
+#
+# If a LocalFrame is given, positions are in that frame rather than relative
+# to the first latitude, so they're the same from one call to the next.
+#
+# If tolerance is given, samples within about that many meters are merged by
+# averaging them, see mergeNearby, and the indices are of the last object of
+# each merged group.
+#
+# If a TelemetryCleaner is given, the samples it rejects are dropped first.
+#
+# Returns a dictionary of the columns, the indices of the objects that were
+# kept, and lat_0, or None if no samples were kept.
+#
+def networkColumns(networkData, frame=None, tolerance=None, cleaner=None):
+    # One pass through the objects, then everything else is on arrays
+    values = np.array([(row['time'], row['lat'], row['lon'], row['energy'],
+        row.get('alt', np.nan)) for row in networkData],
+        dtype=float).reshape(-1, 5)
+    index = np.arange(len(values))
+
+    if cleaner is not None:
+        time, lat, long, energy, alt = values.T
+        index = np.flatnonzero(cleaner.keep({'time': time, 'lat': lat,
+            'long': long, 'energy': energy, 'alt': alt}))
+        values = values[index]
+
+    if not len(values):
+        return None
+
+    time, lat, long, energy, _ = values.T
+
+    if frame is not None:
+        lat_0 = frame.lat_0
+        x, y = frame.toXY(lat, long)
+    else:
+        # Just take the first lattitude as the center of our map
+        lat_0 = lat[0]
         x, y = latLongToXY(lat, long, lat_0)
-        data = data.append(pd.DataFrame([[time, x, y, vel, lat, long]], index=[index],
-                                        columns=['time','x','y','VelDown',
-                                                 'Latitude', 'Longitude']))
 
-    # Try to shrink the range of X-Y values if desired
-    if startAtZero:
-        data[['x']] -= data[['x']].iloc[0]
-        data[['y']] -= data[['y']].iloc[0]
-    elif normalize:
-        minX, maxX = np.min(data[['x']]), np.max(data[['x']])
-        minY, maxY = np.min(data[['y']]), np.max(data[['y']])
-        data[['x']] -= minX
-        data[['y']] -= minY
-        data[['x']] /= maxX-minX
-        data[['y']] /= maxY-minY
+    if tolerance:
+        columns, last = mergeNearby({
+            'time': time,
+            'x': x,
+            'y': y,
+            'energy': energy,
+            'Latitude': lat,
+            'Longitude': long,
+        }, tolerance)
+
+        return columns, index[last], lat_0
 
     # For GPR (time,x,y) must be unique
-    #data = data.drop_duplicates(subset=['time','x','y'])
-    data = data.drop_duplicates(subset=['x','y'])
+    keep = uniqueRows(np.vstack((x, y)).T)
 
-    return data, lat_0
+    columns = {
+        'time': time[keep],
+        'x': x[keep],
+        'y': y[keep],
+        'energy': energy[keep],
+        'Latitude': lat[keep],
+        'Longitude': long[keep],
+    }
+
+    return columns, index[keep], lat_0
 
 #
-# Read data from a deque of objects from the network
+# Read data from a deque of objects from the network, optionally converting
+# positions to a LocalFrame, merging nearby samples, and dropping bad ones,
+# see networkColumns
 #
-def readNetworkData(networkData):
+def readNetworkData(networkData, frame=None, tolerance=None, cleaner=None):
     if not networkData:
         return None
 
     # Format so so we can run GPR on it
-    data = pd.DataFrame()
-
-    # Just take the first lattitude as the center of our map
-    lat_0 = networkData[0]["lat"]
+    result = networkColumns(networkData, frame, tolerance, cleaner)
 
-    # Get the data we care about and convert Lat-Long to X-Y
-    for index, row in enumerate(networkData):
-        time = row['time']
-        lat = row['lat']
-        long = row['lon']
-        energy = row['energy']
-        x, y = latLongToXY(lat, long, lat_0)
-        data = data.append(pd.DataFrame([[time, x, y, energy, lat, long]], index=[index],
-                                        columns=['time', 'x','y','energy',
-                                                 'Latitude', 'Longitude']))
+    if result is None:
+        return None
 
-    # For GPR (time,x,y) must be unique
-    #data = data.drop_duplicates(subset=['time','x','y'])
-    data = data.drop_duplicates(subset=['x','y'])
+    columns, index, lat_0 = result
+    data = pd.DataFrame(columns, index=index,
+                        columns=['time', 'x', 'y', 'energy',
+                                 'Latitude', 'Longitude'])
 
     return data, lat_0
 
+#
+# Read data from a deque of objects from the network directly into the arrays
+# we need to run GPR, without a DataFrame
+#
+# Returns [t,x,y] timepos, [energy] measurements, and lat_0, or None if there
+# are no samples.
+#
+def readNetworkArrays(networkData, frame=None, tolerance=None, cleaner=None):
+    if not networkData:
+        return None
+
+    result = networkColumns(networkData, frame, tolerance, cleaner)
+
+    if result is None:
+        return None
+
+    columns, index, lat_0 = result
+    timepos = np.vstack((columns['time'], columns['x'], columns['y'])).T
+    measurements = columns['energy'][:,np.newaxis]
+
+    return timepos, measurements, lat_0
+
 #
 # Compare Lat-Long with X-Y
 #
@@ -179,3 +601,43 @@ def windowSubset(df, start, size):
 #
 def shrinkSamples(df, n):
     return df.iloc[::n, :]
+
+#
+# Like windowSubset and shrinkSamples but in seconds rather than samples, so
+# they don't depend on the rate the data was recorded at, which may not even
+# be constant. The time column must be sorted.
+#
+
+#
+# Indices [begin, end) of the samples from start to start+duration seconds
+#
+def timeWindowBounds(times, start, duration):
+    times = np.asarray(times)
+    return np.searchsorted(times, start), np.searchsorted(times, start+duration)
+
+#
+# Window of duration seconds starting at time start, a slice of the rows
+# rather than a copy
+#
+def timeWindowSubset(df, start, duration):
+    begin, end = timeWindowBounds(df['time'].values, start, duration)
+    return df.iloc[begin:end, :]
+
+#
+# Indices of the first sample in each interval seconds, i.e. about one sample
+# every interval seconds however irregular the rate is
+#
+def decimateTimes(times, interval):
+    times = np.asarray(times)
+
+    if not len(times):
+        return np.arange(0)
+
+    bins = np.floor((times - times[0])/interval)
+    return np.flatnonzero(np.concatenate(([True], bins[1:] != bins[:-1])))
+
+#
+# Take only about one sample every interval seconds
+#
+def shrinkSamplesByTime(df, interval):
+    return df.iloc[decimateTimes(df['time'].values, interval), :]
@@ -3,6 +3,9 @@
 #
 
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy.ndimage import maximum_filter, minimum_filter, label
+from scipy.linalg import cho_factor, cho_solve
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
@@ -28,7 +31,7 @@ def evalMSE(predicted, correct):
 # http://scikit-learn.org/stable/modules/generated/sklearn.gaussian_process.GaussianProcess.html
 class GPRParams:
     def __init__(self, theta0=1e-1, thetaL=None, thetaU=None,
-                 nugget=None, random_start=1):
+                 nugget=None, random_start=1, kernel='isotropic', angle=None):
         # Since thetaL and thetaU are specified, theta0 is the starting point
         # for the maximum likelihood estimation of the best set of parameters
         #
@@ -64,10 +67,246 @@ class GPRParams:
         # Default does not use random starting point (random_start = 1)
         self.random_start = random_start
 
+        # Which correlation model to use:
+        #  - isotropic: one length scale for both x and y
+        #  - anisotropic: separate x and y length scales, for thermals that
+        #    have been stretched out by the wind
+        #  - rotated: separate length scales along two axes at an angle that is
+        #    also estimated with MLE (only when thetaL and thetaU are given)
+        #
+        # A scalar theta0, thetaL, or thetaU is used for each axis.
+        #
+        # Default is the isotropic squared exponential
+        self.kernel = kernel
+
+        # Fixed rotation in radians (e.g. from the wind direction) of the
+        # anisotropic kernel's axes relative to the x-y axes. This rotates the
+        # inputs, so unlike the rotated kernel's estimated angle, it is the
+        # actual angle in the x-y plane.
+        #
+        # Default is None, so the axes are the x and y axes
+        self.angle = angle
+
+    # The correlation model to give to scikit-learn
+    def corr(self):
+        if self.kernel == 'isotropic':
+            return 'squared_exponential'
+        elif self.kernel == 'anisotropic':
+            return anisotropic_squared_exponential
+        elif self.kernel == 'rotated':
+            return rotated_squared_exponential
+        else:
+            raise ValueError("Unknown kernel: %s" % self.kernel)
+
+    # Expand theta0, thetaL, and thetaU to the number of parameters the kernel
+    # uses, i.e. (x, y) for anisotropic and (major, minor, angle) for rotated
+    def thetas(self):
+        if self.kernel == 'isotropic':
+            return self.theta0, self.thetaL, self.thetaU
+
+        def perAxis(theta):
+            if theta is None:
+                return None
+            return np.ones(2)*np.asarray(theta, dtype=float).flatten()
+
+        theta0 = perAxis(self.theta0)
+        thetaL = perAxis(self.thetaL)
+        thetaU = perAxis(self.thetaU)
+
+        # MLE is done in log10 space, so the angle has to stay positive. Since
+        # the kernel is symmetric, (0, pi] covers all orientations.
+        if self.kernel == 'rotated':
+            theta0 = np.append(theta0, np.pi/4)
+
+            if thetaL is not None and thetaU is not None:
+                thetaL = np.append(thetaL, 1e-3)
+                thetaU = np.append(thetaU, np.pi)
+
+        return theta0, thetaL, thetaU
+
     # For debugging, when printing
     def __str__(self):
-        return "Theta0: %f, ThetaL: %f, ThetaU: %f, Nugget: %f, RandomStart: %d" % (
-            self.theta0, self.thetaL, self.thetaU, self.nugget, self.random_start)
+        return "Theta0: %s, ThetaL: %s, ThetaU: %s, Nugget: %s, RandomStart: %d, Kernel: %s, Angle: %s" % (
+            self.theta0, self.thetaL, self.thetaU, self.nugget, self.random_start,
+            self.kernel, self.angle)
+
+#
+# Quickly guess the GP hyperparameters from the data rather than starting MLE
+# from a fixed theta0
+#
+# The length scale is the median distance between samples, and the nugget is
+# the fraction of the measurement variance that's noise. The noise is estimated
+# from the differences between consecutive samples, which are close together
+# along the path so their true values are about the same.
+#
+# scikit-learn normalizes the inputs and measurements, so these are computed on
+# normalized data, i.e. theta = 1/(2 l^2) with l in standard deviations and the
+# nugget relative to a variance of one.
+#
+# Mle - if False, skip MLE and just use the guess, for the tightest time
+#     budgets. If True, do one MLE run starting at the guess, within a factor
+#     of span of it.
+# Nugget - if given, use it rather than estimating it
+# MaxSamples - only use this many samples evenly spaced along the path for the
+#     pairwise distances, since there are O(n^2) of them
+#
+def heuristicGPRParams(timepos, measurements, mle=False, span=1e2,
+        kernel='isotropic', nugget=None, maxSamples=500):
+    path = np.asarray(timepos)[:,1:3]
+    y = np.asarray(measurements, dtype=float).reshape(-1)
+
+    # Normalize like scikit-learn
+    std = np.std(path, axis=0)
+    std[std == 0] = 1
+    path = (path - np.mean(path, axis=0))/std
+
+    if path.shape[0] > maxSamples:
+        path = path[np.linspace(0, path.shape[0]-1, maxSamples).astype(int)]
+
+    # Componentwise distances between all pairs of samples
+    i, j = np.triu_indices(path.shape[0], k=1)
+    d = np.abs(path[i] - path[j])
+
+    if kernel == 'isotropic':
+        l = np.median(np.sqrt(np.sum(d**2, axis=1)))
+    else:
+        l = np.median(d, axis=0)
+
+    l = np.maximum(l, 1e-3)
+    theta = 1.0/(2*l**2)
+
+    if nugget is None:
+        variance = np.var(y)
+
+        if variance > 0 and len(y) > 1:
+            nugget = np.var(np.diff(y))/2/variance
+        else:
+            nugget = 1
+
+        nugget = float(np.clip(nugget, 1e-4, 10))
+
+    if mle:
+        return GPRParams(theta0=theta, thetaL=theta/span, thetaU=theta*span,
+                nugget=nugget, random_start=1, kernel=kernel)
+
+    return GPRParams(theta0=theta, nugget=nugget, kernel=kernel)
+
+#
+# Anisotropic squared-exponential correlation models
+#
+# scikit-learn calls these with the componentwise distances between all pairs
+# of points at once, so everything is computed for all of d at a time rather
+# than looping over points. If gradient=True, also return the derivative of r
+# with respect to each of the theta parameters, shape (n_eval, n_theta), for
+# use with gradient-based optimizers (scikit-learn's COBYLA doesn't use it).
+#
+# Note scikit-learn normalizes the inputs by their standard deviation before
+# computing d, so these length scales are relative to the spread of the data.
+#
+def anisotropic_squared_exponential(theta, d, gradient=False):
+    """
+    Anisotropic squared exponential:
+
+        theta, d --> r(theta, d) = exp( - theta_x * dx^2 - theta_y * dy^2 )
+
+    Parameters
+    ----------
+    theta : array_like
+        An array with shape 2 giving theta_x and theta_y.
+
+    d : array_like
+        An array with shape (n_eval, 2) giving the componentwise distances
+        between locations x and x' at which the correlation model should be
+        evaluated.
+
+    gradient : bool
+        Whether to also return the gradient with respect to theta.
+
+    Returns
+    -------
+    r : array_like
+        An array with shape (n_eval, ) containing the values of the
+        autocorrelation model.
+
+    dr : array_like
+        If gradient, an array with shape (n_eval, 2) containing dr/dtheta.
+    """
+    theta = np.asarray(theta, dtype=float).reshape(-1)
+    d = np.asarray(d, dtype=float)
+
+    if theta.size != 2 or d.shape[1] != 2:
+        raise ValueError("Anisotropic kernel requires 2 thetas and 2D inputs")
+
+    d2 = d ** 2
+    r = np.exp(-np.dot(d2, theta))
+
+    if gradient:
+        return r, -d2 * r[:, np.newaxis]
+
+    return r
+
+def rotated_squared_exponential(theta, d, gradient=False):
+    """
+    Rotated anisotropic squared exponential:
+
+        theta, d --> r(theta, d) = exp( - theta_u * du^2 - theta_v * dv^2 )
+
+    where du and dv are d rotated by the angle phi:
+
+        du =  cos(phi) * dx + sin(phi) * dy
+        dv = -sin(phi) * dx + cos(phi) * dy
+
+    Parameters
+    ----------
+    theta : array_like
+        An array with shape 3 giving theta_u, theta_v, and phi.
+
+    d : array_like
+        An array with shape (n_eval, 2) giving the componentwise distances
+        between locations x and x' at which the correlation model should be
+        evaluated.
+
+    gradient : bool
+        Whether to also return the gradient with respect to theta.
+
+    Returns
+    -------
+    r : array_like
+        An array with shape (n_eval, ) containing the values of the
+        autocorrelation model.
+
+    dr : array_like
+        If gradient, an array with shape (n_eval, 3) containing dr/dtheta.
+    """
+    theta = np.asarray(theta, dtype=float).reshape(-1)
+    d = np.asarray(d, dtype=float)
+
+    if theta.size != 3 or d.shape[1] != 2:
+        raise ValueError("Rotated kernel requires 3 thetas and 2D inputs")
+
+    theta_u, theta_v, phi = theta
+    c, s = np.cos(phi), np.sin(phi)
+    du = c*d[:,0] + s*d[:,1]
+    dv = -s*d[:,0] + c*d[:,1]
+    r = np.exp(-theta_u*du**2 - theta_v*dv**2)
+
+    if gradient:
+        # d(du)/d(phi) = dv and d(dv)/d(phi) = -du
+        dr = np.empty((d.shape[0], 3))
+        dr[:,0] = -du**2 * r
+        dr[:,1] = -dv**2 * r
+        dr[:,2] = -2*(theta_u - theta_v)*du*dv * r
+        return r, dr
+
+    return r
+
+#
+# Rotate points by -angle, i.e. into the frame of a kernel whose axes are at
+# the given angle in the x-y plane
+#
+def rotatePoints(points, angle):
+    c, s = np.cos(angle), np.sin(angle)
+    return np.dot(points, np.array([[c, -s], [s, c]]))
 
 #
 # Custom correlation model
@@ -172,25 +411,73 @@ def time_squared_exponential(theta, d):
             np.exp(-theta_t.reshape(1, n_features) * dt ** 2)
 
 #
-# Gaussian Process Regression to learn thermals
+# Predict over a grid in chunks of at most chunkSize points, so we never need
+# the whole (grid points x samples) cross-correlation matrix and the MSE
+# intermediates in memory at once. Each point's prediction only depends on that
+# point, so the result is the same as predicting the whole grid at once.
 #
-# Extent - predict over bounding box of measurements given but extend this
-#     bounding box this much in each direction
-# Points - how much to divide each axis of the bounding box into, predicting
-#     at each of these points
+# If threads is set, predict the chunks on that many threads. Numpy releases
+# the GIL in the matrix operations, so this does run in parallel. At most
+# threads chunks are in memory at a time.
 #
-def GPR(timepos, measurements, gprParams, extent, points):
-    # Compute bounds based on measurements
-    path = timepos[:,1:timepos.shape[1]] # get [x,y] from [t,x,y]
+def predictGrid(gp, grid, eval_MSE=True, chunkSize=2500, threads=None):
+    n = grid.shape[0]
+
+    if not chunkSize or chunkSize >= n:
+        return gp.predict(grid, eval_MSE=eval_MSE)
+
+    # Do the first chunk to find out the output shape
+    first = gp.predict(grid[:chunkSize], eval_MSE=eval_MSE)
+
+    if eval_MSE:
+        prediction = np.empty((n,) + first[0].shape[1:], dtype=first[0].dtype)
+        MSE = np.empty((n,) + first[1].shape[1:], dtype=first[1].dtype)
+        prediction[:chunkSize], MSE[:chunkSize] = first
+    else:
+        prediction = np.empty((n,) + first.shape[1:], dtype=first.dtype)
+        prediction[:chunkSize] = first
+
+    # Write each chunk directly into the output
+    def predictChunk(start):
+        end = min(start+chunkSize, n)
+
+        if eval_MSE:
+            prediction[start:end], MSE[start:end] = gp.predict(grid[start:end],
+                    eval_MSE=True)
+        else:
+            prediction[start:end] = gp.predict(grid[start:end])
+
+    starts = range(chunkSize, n, chunkSize)
+
+    if threads and threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            # list() so exceptions in any of the threads are raised here
+            list(executor.map(predictChunk, starts))
+    else:
+        for start in starts:
+            predictChunk(start)
+
+    if eval_MSE:
+        return prediction, MSE
+
+    return prediction
+
+#
+# Bounds of the grid to predict over, the bounding box of the path extended by
+# extent in each direction
+#
+def predictionBounds(path, extent):
     pos_min_x, pos_max_x, pos_min_y, pos_max_y = boundsFromPath(path)
 
-    # Extend the prediction out from the measurements given
-    pos_min_x -= extent
-    pos_max_x += extent
-    pos_min_y -= extent
-    pos_max_y += extent
+    return pos_min_x-extent, pos_max_x+extent, pos_min_y-extent, pos_max_y+extent
+
+#
+# Generate all the points we want to output at, dividing each axis of the
+# bounds into the specified number of points
+#
+def makeGrid(bounds, points):
+    pos_min_x, pos_max_x, pos_min_y, pos_max_y = bounds
 
-    # Generate all the points we want to output at
     # See: http://stackoverflow.com/a/32208788
     #grid_x, grid_y, grid_time = np.meshgrid(
     #    np.arange(pos_min_x, pos_max_x, (pos_max_x-pos_min_x)/points),
@@ -202,22 +489,180 @@ def GPR(timepos, measurements, gprParams, extent, points):
     grid = np.vstack((grid_x.flatten(), grid_y.flatten())).T
     #grid_time = np.vstack((grid_x.flatten(), grid_y.flatten(), grid_time.flatten())).T
 
-    gp = GaussianProcess(corr='squared_exponential',
+    return grid, grid_x, grid_y
+
+#
+# Reuse the prediction grid between GPR calls, since the bounds of the path
+# barely move between consecutive iterations of the processing loop
+#
+# Tolerance - reuse the last grid if none of the bounds moved more than this
+#     many meters and the number of points is the same
+# Lattice - if set, snap the bounds outward to multiples of this many meters,
+#     so small changes in the bounds give exactly the same grid
+#
+class GridCache:
+    def __init__(self, tolerance=0, lattice=None):
+        self.tolerance = tolerance
+        self.lattice = lattice
+
+        # The last grid and what it was generated from
+        self.bounds = None
+        self.points = None
+        self.grids = None
+
+        # Values computed from the grid with derived(), cleared when the grid
+        # changes
+        self.derivedValues = {}
+
+        # For debugging, how often we could reuse the grid
+        self.hits = 0
+        self.misses = 0
+
+    # Get (grid, grid_x, grid_y) for these bounds, reusing the last one if
+    # possible. These are shared between calls, so don't modify them.
+    def grid(self, bounds, points):
+        bounds = np.asarray(bounds, dtype=float)
+
+        if self.lattice:
+            bounds[0::2] = np.floor(bounds[0::2]/self.lattice)*self.lattice
+            bounds[1::2] = np.ceil(bounds[1::2]/self.lattice)*self.lattice
+
+        if self.grids is not None and points == self.points and \
+                np.all(np.abs(bounds - self.bounds) <= self.tolerance):
+            self.hits += 1
+            return self.grids
+
+        self.misses += 1
+        self.bounds = bounds
+        self.points = points
+        self.grids = makeGrid(bounds, points)
+        self.derivedValues = {}
+
+        for g in self.grids:
+            g.flags.writeable = False
+
+        return self.grids
+
+    # Something computed from the current grid, e.g. the grid rotated into the
+    # kernel's frame, only recomputed when the grid changes
+    def derived(self, name, compute):
+        if name not in self.derivedValues:
+            self.derivedValues[name] = compute(self.grids[0])
+
+        return self.derivedValues[name]
+
+#
+# The GPR standard deviation, but only computed at the grid points we actually
+# look at, e.g. sigma[index] at the thermal center. Predicting the MSE costs an
+# extra triangular solve per point, which we can skip for the rest of the grid.
+#
+# Index with an integer for a single value or with a slice or an array of
+# indices for a neighborhood of points.
+#
+class LazySigma:
+    def __init__(self, gp, grid):
+        self.gp = gp
+        self.grid = grid
+
+    def __len__(self):
+        return self.grid.shape[0]
+
+    def __getitem__(self, index):
+        points = self.grid[index]
+        single = points.ndim == 1
+
+        prediction, MSE = self.gp.predict(np.atleast_2d(points), eval_MSE=True)
+        sigma = np.sqrt(MSE)
+
+        if single:
+            return sigma[0]
+
+        return sigma
+
+#
+# Create the GP and fit it to the [x,y] path and measurements
+#
+# If gprParams.angle is set, this is fit in the kernel's frame, so predict at
+# rotatePoints(points, gprParams.angle) rather than at the points themselves.
+#
+def fitGPR(path, measurements, gprParams):
+    theta0, thetaL, thetaU = gprParams.thetas()
+    gp = GaussianProcess(corr=gprParams.corr(),
     #gp = GaussianProcess(corr=time_squared_exponential,
-                         theta0=gprParams.theta0,
-                         thetaL=gprParams.thetaL,
-                         thetaU=gprParams.thetaU,
+                         theta0=theta0,
+                         thetaL=thetaL,
+                         thetaU=thetaU,
                          nugget=gprParams.nugget,
                          random_start=gprParams.random_start)
 
+    if gprParams.angle is not None:
+        path = rotatePoints(path, gprParams.angle)
+
     # Regression, fit to data using Maximum Likelihood Estimation of the parameters
     #gp.fit(timepos, measurements)
     gp.fit(path, measurements)
 
+    return gp
+
+#
+# Log marginal likelihood per sample of a fit GP, so that fits to different
+# numbers of samples (e.g. different window sizes) can be compared
+#
+# scikit-learn's reduced likelihood is -sigma2 * det(R)^(1/n) for the
+# normalized measurements, so this is the concentrated log likelihood divided
+# by n, converted back to the units of the measurements.
+#
+def logLikelihoodGPR(gp):
+    return -0.5*(np.log(-gp.reduced_likelihood_function_value_) + 1 +
+            np.log(2*np.pi)) - np.mean(np.log(gp.y_std))
+
+#
+# Gaussian Process Regression to learn thermals
+#
+# Extent - predict over bounding box of measurements given but extend this
+#     bounding box this much in each direction
+# Points - how much to divide each axis of the bounding box into, predicting
+#     at each of these points
+# ChunkSize - predict at most this many grid points at a time to limit memory
+#     usage, or None to predict the whole grid at once
+# Threads - how many threads to predict chunks on, see predictGrid
+# GridCache - if given, a GridCache to reuse the grid from
+# Eval_MSE - if False, only predict the mean over the grid and return a
+#     LazySigma that computes the standard deviation where it's needed
+#
+def GPR(timepos, measurements, gprParams, extent, points, chunkSize=2500,
+        threads=None, gridCache=None, eval_MSE=True):
+    # Compute bounds based on measurements, extended out from the measurements
+    path = timepos[:,1:timepos.shape[1]] # get [x,y] from [t,x,y]
+    bounds = predictionBounds(path, extent)
+
+    if gridCache:
+        grid, grid_x, grid_y = gridCache.grid(bounds, points)
+    else:
+        grid, grid_x, grid_y = makeGrid(bounds, points)
+
+    gp = fitGPR(path, measurements, gprParams)
+
+    # For a fixed kernel angle, predict in the kernel's frame
+    grid_kernel = grid
+
+    if gprParams.angle is not None:
+        if gridCache:
+            grid_kernel = gridCache.derived(('rotated', gprParams.angle),
+                    lambda g: rotatePoints(g, gprParams.angle))
+        else:
+            grid_kernel = rotatePoints(grid, gprParams.angle)
+
     # Prediction over our grid
-    prediction, MSE = gp.predict(grid, eval_MSE=True)
-    #prediction, MSE = gp.predict(grid_time, eval_MSE=True)
-    sigma = np.sqrt(MSE)
+    if eval_MSE:
+        prediction, MSE = predictGrid(gp, grid_kernel, eval_MSE=True,
+                chunkSize=chunkSize, threads=threads)
+        #prediction, MSE = gp.predict(grid_time, eval_MSE=True)
+        sigma = np.sqrt(MSE)
+    else:
+        prediction = predictGrid(gp, grid_kernel, eval_MSE=False,
+                chunkSize=chunkSize, threads=threads)
+        sigma = LazySigma(gp, grid_kernel)
 
     return (grid, grid_x, grid_y), prediction, sigma
 
@@ -232,27 +677,260 @@ def GPRtoThermal(grid, prediction, sigma):
 
     return x, y, prediction[index], sigma[index]
 
+#
+# Take GPR results and find all the thermals, not just the highest one
+#
+# A thermal is a local maximum of the prediction, i.e. the highest point within
+# neighborhood grid points in each direction, where we're confident there's
+# lift: prediction - z*uncertainty > minLift. Flat regions (e.g. far from the
+# data where it reverts to the mean) aren't counted as maxima, and a maximum
+# that's flat on top, i.e. neighboring grid points tied for the highest, is
+# one thermal at the grid point nearest the middle of it.
+#
+# Shape is the shape of the grid before flattening, i.e. grid_x.shape. Sigma
+# may be a LazySigma, in which case it's only computed at the maxima.
+#
+# Returns a list of (x, y, prediction, uncertainty), sorted by the lower
+# confidence bound, i.e. most certain lift first.
+#
+def GPRtoThermals(grid, shape, prediction, sigma, neighborhood=2, z=1.96/2,
+        minLift=0.5):
+    prediction = np.asarray(prediction).reshape(-1)
+    surface = prediction.reshape(shape)
+    size = 2*neighborhood+1
+
+    peaks = (surface == maximum_filter(surface, size=size, mode='nearest')) & \
+            (surface > minimum_filter(surface, size=size, mode='nearest'))
+
+    # Since sigma >= 0, we can skip ones that will be below minLift anyway
+    # before computing sigma
+    peaks &= surface > minLift
+    labels, count = label(peaks, structure=np.ones((3, 3)))
+
+    if count == 0:
+        return []
+
+    # One grid point per group of tied neighboring peaks, the one closest to
+    # the group's center
+    indices = np.flatnonzero(peaks.reshape(-1))
+    group = labels.reshape(-1)[indices] - 1
+    rows, cols = np.unravel_index(indices, shape)
+    sizes = np.bincount(group, minlength=count)
+    distance = (rows - (np.bincount(group, weights=rows)/sizes)[group])**2 + \
+            (cols - (np.bincount(group, weights=cols)/sizes)[group])**2
+    order = np.lexsort((distance, group))
+    indices = indices[order[np.r_[True, np.diff(group[order]) != 0]]]
+
+    peakPrediction = prediction[indices]
+    peakSigma = np.asarray(sigma[indices]).reshape(-1)
+    bound = peakPrediction - z*peakSigma
+    order = np.argsort(-bound)
+    order = order[bound[order] > minLift]
+
+    return [(grid[indices[i]][0], grid[indices[i]][1], peakPrediction[i],
+             peakSigma[i]) for i in order]
+
 #
 # Get thermal from GPR without plotting
 #
-def ThermalGPR(timepos, measurements, gprParams, extent=10, points=50):
+# Only the mean is predicted over the grid, and the uncertainty is only
+# computed at the thermal we find.
+#
+def ThermalGPR(timepos, measurements, gprParams, extent=10, points=50,
+        chunkSize=2500, threads=None, gridCache=None):
     # Run GPR
     (grid, grid_x, grid_y), prediction, sigma = GPR(timepos, measurements,
-            gprParams, extent, points)
+            gprParams, extent, points, chunkSize, threads, gridCache,
+            eval_MSE=False)
 
     # Get thermal
     return GPRtoThermal(grid, prediction, sigma)
 
+#
+# Get all the thermals we're confident in from GPR without plotting, see
+# GPRtoThermals
+#
+def ThermalsGPR(timepos, measurements, gprParams, extent=10, points=50,
+        chunkSize=2500, threads=None, gridCache=None, neighborhood=2,
+        z=1.96/2, minLift=0.5):
+    # Run GPR
+    (grid, grid_x, grid_y), prediction, sigma = GPR(timepos, measurements,
+            gprParams, extent, points, chunkSize, threads, gridCache,
+            eval_MSE=False)
+
+    # Get thermals
+    return GPRtoThermals(grid, grid_x.shape, prediction, sigma, neighborhood,
+            z, minLift)
+
+#
+# Random Fourier feature (RFF) approximation of the squared-exponential GP
+#
+# The squared-exponential kernel is approximated with features
+#   phi(x) = sqrt(2*signalVariance/D) * cos(W x + b)
+# with W ~ N(0, I/lengthScale^2) and b ~ U(0, 2 pi), so that the GP becomes
+# Bayesian linear regression on D features. Then adding k samples costs
+# O(k D^2 + D^3), i.e. O(D^2) per sample when adding at least D at a time, no
+# matter how many samples we've seen, and predicting the mean costs O(D) per
+# point.
+#
+# Unlike GPRParams, the length scale is in meters since we don't normalize the
+# inputs. There's no MLE, so pick the length scale to be about the size of the
+# thermals we're looking for.
+#
+class RFFParams:
+    def __init__(self, lengthScale=20.0, signalVariance=1.0, noiseVariance=1.0,
+                 features=200, biasVariance=10.0, seed=0):
+        # Length scale of the squared-exponential kernel in meters
+        self.lengthScale = lengthScale
+
+        # Prior variance of the function, like the scale of the kernel
+        self.signalVariance = signalVariance
+
+        # Variance of the measurement noise, like the nugget
+        self.noiseVariance = noiseVariance
+
+        # Number of random features D, more approximates the kernel better but
+        # costs more per update
+        self.features = features
+
+        # Prior variance of a constant offset added to the function, since the
+        # measurements usually aren't zero mean
+        self.biasVariance = biasVariance
+
+        # Seed for the random features, so the features (and the features of
+        # a cached grid) are the same every time
+        self.seed = seed
+
+    # For debugging, when printing
+    def __str__(self):
+        return "LengthScale: %f, SignalVariance: %f, NoiseVariance: %f, Features: %d, BiasVariance: %f, Seed: %d" % (
+            self.lengthScale, self.signalVariance, self.noiseVariance,
+            self.features, self.biasVariance, self.seed)
+
+class RFFGPR:
+    def __init__(self, rffParams):
+        self.rffParams = rffParams
+
+        # Spectral density of exp(-|d|^2/(2 l^2)) is N(0, I/l^2)
+        random = np.random.RandomState(rffParams.seed)
+        self.W = random.normal(scale=1.0/rffParams.lengthScale,
+                size=(2, rffParams.features))
+        self.b = random.uniform(0, 2*np.pi, rffParams.features)
+        self.scale = np.sqrt(2.0*rffParams.signalVariance/rffParams.features)
+
+        # Posterior mean and covariance of the weights, starting at the prior.
+        # The last weight is the constant offset.
+        self.mean = np.zeros(rffParams.features+1)
+        self.cov = np.diag(np.append(np.ones(rffParams.features),
+            rffParams.biasVariance))
+
+    # Features of the [x,y] points, shape (n, D+1)
+    def features(self, points):
+        phi = np.empty((points.shape[0], self.rffParams.features+1))
+        phi[:,:-1] = np.cos(np.dot(points, self.W) + self.b)
+        phi[:,:-1] *= self.scale
+        phi[:,-1] = 1
+
+        return phi
+
+    # Add k samples at the [x,y] path. Pass phi if the features of the path
+    # have already been computed.
+    #
+    # With at most D+1 samples, this updates the covariance directly, costing
+    # O(k D^2 + k^3). With more, e.g. a whole window at once, it adds them to
+    # the precision (inverse covariance) instead, costing O(k D^2 + D^3), so
+    # the cost never grows faster than linearly in k.
+    def update(self, path, measurements, phi=None):
+        if phi is None:
+            phi = self.features(path)
+
+        y = np.asarray(measurements, dtype=float).reshape(-1)
+        noise = self.rffParams.noiseVariance
+
+        if phi.shape[0] > phi.shape[1]:
+            # Information form: precision += phi^T phi/noise, and the
+            # precision times the mean += phi^T y/noise
+            identity = np.eye(phi.shape[1])
+            precision = cho_solve(cho_factor(self.cov), identity)
+            information = np.dot(precision, self.mean) + np.dot(phi.T, y)/noise
+            precision += np.dot(phi.T, phi)/noise
+
+            factor = cho_factor(precision)
+            self.mean = cho_solve(factor, information)
+            self.cov = cho_solve(factor, identity)
+            self.cov = (self.cov + self.cov.T)/2
+            return
+
+        # Woodbury identity for k new samples, which with one sample is the
+        # usual recursive least squares update
+        SPhi = np.dot(self.cov, phi.T)
+        innovation = np.dot(phi, SPhi)
+        innovation[np.diag_indices_from(innovation)] += noise
+        gain = np.linalg.solve(innovation, SPhi.T).T
+
+        self.mean += np.dot(gain, y - np.dot(phi, self.mean))
+        self.cov -= np.dot(gain, SPhi.T)
+
+        # Keep it symmetric after many updates
+        self.cov = (self.cov + self.cov.T)/2
+
+    # Predict at the points, or at the features phi if already computed. The
+    # MSE is the variance of the function, not including measurement noise.
+    def predict(self, points=None, eval_MSE=False, phi=None):
+        if phi is None:
+            phi = self.features(points)
+
+        prediction = np.dot(phi, self.mean)
+
+        if eval_MSE:
+            MSE = np.einsum('ij,ij->i', np.dot(phi, self.cov), phi)
+            return prediction, np.maximum(MSE, 0)
+
+        return prediction
+
+#
+# Get thermal with the RFF approximation rather than the exact GP, the same as
+# ThermalGPR otherwise
+#
+def ThermalRFF(timepos, measurements, rffParams, extent=10, points=50,
+        gridCache=None):
+    path = timepos[:,1:timepos.shape[1]] # get [x,y] from [t,x,y]
+    model = RFFGPR(rffParams)
+    model.update(path, measurements)
+
+    # The features of the grid only depend on the grid and the random
+    # features, so they can be reused when the grid is
+    bounds = predictionBounds(path, extent)
+
+    if gridCache:
+        grid, grid_x, grid_y = gridCache.grid(bounds, points)
+        phi = gridCache.derived(('rff', rffParams.lengthScale,
+            rffParams.signalVariance, rffParams.features, rffParams.seed),
+            model.features)
+    else:
+        grid, grid_x, grid_y = makeGrid(bounds, points)
+        phi = model.features(grid)
+
+    # Only the mean over the grid, and the uncertainty at the thermal
+    prediction = model.predict(phi=phi)
+    index = np.argmax(prediction)
+    MSE = model.predict(eval_MSE=True, phi=phi[index:index+1])[1]
+
+    return grid[index][0], grid[index][1], prediction[index], np.sqrt(MSE[0])
+
 #
 # Get thermal from GPR with plotting
 #
 def ThermalGPRPlot(fig, timepos, measurements, gprParams, extent=10, points=50,
-        fast=False, field=None):
+        fast=False, field=None, chunkSize=2500, threads=None, gridCache=None):
 
     path = timepos[:,1:timepos.shape[1]] # get [x,y] from [t,x,y]
 
+    # When fast, we don't plot the confidence intervals, so we only need the
+    # uncertainty at the thermal
     (grid, grid_x, grid_y), prediction, sigma = GPR(timepos, measurements,
-            gprParams, extent, points)
+            gprParams, extent, points, chunkSize, threads, gridCache,
+            eval_MSE=not fast)
 
     if field:
         Z = np.zeros(grid.shape)
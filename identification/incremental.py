@@ -0,0 +1,337 @@
+#
+# GPR on overlapping sliding windows of a whole flight log, for offline
+# processing
+#
+# With e.g. 45-second windows that slide by 15 seconds, two thirds of each
+# window's samples were in the previous one. With fixed hyperparameters, the
+# kernel matrix of those samples and its Cholesky factor carry over from one
+# window to the next: the new samples are appended to the factor with a block
+# Cholesky step, and the samples that slid out are removed with a rank-k
+# update of the rest of the factor (or, when that's slower, a Cholesky of the
+# kept kernel block, which still skips recomputing the kernel). That's what
+# makes a dense sweep with a small slideBy affordable.
+#
+# When the hyperparameters are fit to each window instead, the kernel and its
+# factor change with every optimizer step, so only the squared distances
+# between the samples are reused, and the search starts at the last window's
+# hyperparameters. Each likelihood evaluation is still a full kernel,
+# Cholesky, and inverse, and the warm start only saves a few iterations.
+#
+# Note this isn't the same model as GPR(): scikit-learn's GaussianProcess
+# normalizes the inputs and measurements and fits theta with COBYLA from random
+# starts, while this uses physical units, only centers the measurements, and
+# fits with L-BFGS-B. Results from the two aren't directly comparable.
+#
+
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve, solve_triangular
+from scipy.linalg.lapack import dpotri
+from scipy.optimize import minimize
+
+from identification.gpr import predictGrid, predictionBounds, makeGrid, \
+    LazySigma, GPRtoThermal
+
+#
+# Squared Euclidean distances between each row of a and each row of b
+#
+def squaredDistances(a, b):
+    d2 = np.sum(a**2, axis=1)[:,np.newaxis] + np.sum(b**2, axis=1) - \
+            2*np.dot(a, b.T)
+    return np.maximum(d2, 0)
+
+#
+# Lower-triangular L with L L^T = L22 L22^T + L21 L21^T, i.e. the Cholesky
+# factor of the kernel matrix of the kept samples when the first samples are
+# removed from a factor [[L11, 0], [L21, L22]]
+#
+# This is a QR of [L22^T; L21^T], done a block of blockSize columns at a time
+# so each step is a small QR and one matrix product rather than a Python loop
+# over every column. It's O(m k^2) for m removed and k kept samples.
+#
+def choleskyRemoveLeading(L22, L21, blockSize=32):
+    R = L22.T.copy()
+    U = L21.T.copy()
+    k = R.shape[0]
+
+    for j in range(0, k, blockSize):
+        e = min(j+blockSize, k)
+        Q, panel = np.linalg.qr(np.vstack((R[j:e,j:e], U[:,j:e])),
+                mode='complete')
+        R[j:e,j:e] = panel[:e-j]
+
+        if e < k:
+            rest = np.dot(Q.T, np.vstack((R[j:e,e:], U[:,e:])))
+            R[j:e,e:] = rest[:e-j]
+            U[:,e:] = rest[e-j:]
+
+    # Make the diagonal positive like a Cholesky factor
+    R *= np.sign(np.diag(R))[:,np.newaxis]
+
+    return R.T
+
+#
+# Exact GP with an isotropic squared-exponential kernel over sliding windows
+# of the samples [begin, end) of a log
+#
+# The hyperparameters are in physical units: the length scale in meters and
+# the signal and noise variances in (m/s)^2. The measurements are centered on
+# the window's mean. If not given, they're guessed from the first window like
+# heuristicGPRParams.
+#
+# Optimize - if True, fit the hyperparameters to each window by maximizing the
+#     likelihood, starting from the previous window's. Otherwise they stay
+#     fixed and the kernel matrix and its factor are updated between windows.
+# Bounds - (min, max) of the length scale, signal variance, and noise variance
+# MaxIter - at most this many optimizer iterations per window
+#
+class SlidingWindowGPR:
+    # Removing samples from the factor is only faster than a Cholesky of the
+    # kept block when there are enough kept samples and few removed, e.g. 14
+    # vs. 23 ms for removing 20 of 1000 but 1.6 vs. 1.1 ms for 10 of 300
+    minUpdateSize = 400
+    maxUpdateFraction = 0.05
+
+    def __init__(self, path, measurements, lengthScale=None,
+            signalVariance=None, noiseVariance=None, optimize=True,
+            bounds=((1.0, 1e3), (1e-4, 1e2), (1e-4, 1e2)), maxIter=50):
+        self.path = np.asarray(path, dtype=float)
+        self.measurements = np.asarray(measurements, dtype=float).reshape(-1)
+        self.optimize = optimize
+        self.logBounds = np.log(bounds)
+        self.maxIter = maxIter
+
+        if lengthScale is None or signalVariance is None or \
+                noiseVariance is None:
+            self.logParams = None
+            self.initial = (lengthScale, signalVariance, noiseVariance)
+        else:
+            self.logParams = np.log([lengthScale, signalVariance,
+                noiseVariance])
+
+        # The current window, the squared distances between its samples (if
+        # up to date), and its kernel matrix and factor
+        self.begin = 0
+        self.end = 0
+        self.D2 = None
+        self.K = None
+        self.L = None
+
+        # How many kernel or distance entries were reused rather than
+        # computed, how many factors were updated rather than recomputed, and
+        # how many optimizer iterations the last fit took
+        self.reused = 0
+        self.computed = 0
+        self.updates = 0
+        self.iterations = 0
+
+    def lengthScale(self):
+        return np.exp(self.logParams[0])
+
+    def signalVariance(self):
+        return np.exp(self.logParams[1])
+
+    def noiseVariance(self):
+        return np.exp(self.logParams[2])
+
+    # Kernel between the [x,y] points a and b, without the noise
+    def kernel(self, a, b):
+        lengthScale, signalVariance, noiseVariance = np.exp(self.logParams)
+        return signalVariance*np.exp(-squaredDistances(a, b)/
+                (2*lengthScale**2))
+
+    # Squared distances between the samples of [begin, end), reusing the
+    # block that overlaps the last window
+    def distances(self, begin, end):
+        n = end - begin
+        D2 = np.empty((n, n))
+        lo, hi = max(begin, self.begin), min(end, self.end)
+
+        if self.D2 is not None and lo < hi:
+            a, b = lo - begin, hi - begin
+            D2[a:b,a:b] = self.D2[lo-self.begin:hi-self.begin,
+                                  lo-self.begin:hi-self.begin]
+            new = np.concatenate((np.arange(a), np.arange(b, n)))
+            self.reused += (b - a)**2
+        else:
+            new = np.arange(n)
+
+        if len(new):
+            path = self.path[begin:end]
+            rows = squaredDistances(path[new], path)
+            D2[new,:] = rows
+            D2[:,new] = rows.T
+            self.computed += n**2 - (n - len(new))**2
+
+        self.begin, self.end, self.D2 = begin, end, D2
+
+        return D2
+
+    # Guess the hyperparameters from the current window, like
+    # heuristicGPRParams but in physical units
+    def guess(self, y):
+        lengthScale, signalVariance, noiseVariance = self.initial
+        variance = max(np.var(y), 1e-4)
+
+        if lengthScale is None:
+            i, j = np.triu_indices(self.D2.shape[0], k=1)
+            lengthScale = np.median(np.sqrt(self.D2[i,j])) if len(i) else 1.0
+        if signalVariance is None:
+            signalVariance = variance
+        if noiseVariance is None:
+            noiseVariance = np.var(np.diff(y))/2 if len(y) > 1 else variance
+
+        return np.clip(np.log([lengthScale, signalVariance, noiseVariance]),
+                self.logBounds[:,0], self.logBounds[:,1])
+
+    # Negative log marginal likelihood of centered measurements y and its
+    # gradient with respect to the log of each hyperparameter
+    def negLogLikelihood(self, logParams, y):
+        lengthScale, signalVariance, noiseVariance = np.exp(logParams)
+        n = len(y)
+
+        E = np.exp(-self.D2/(2*lengthScale**2))
+        K = signalVariance*E
+        K[np.diag_indices(n)] += noiseVariance
+
+        try:
+            factor = cho_factor(K, lower=True, check_finite=False)
+        except np.linalg.LinAlgError:
+            return np.inf, np.zeros(3)
+
+        alpha = cho_solve(factor, y, check_finite=False)
+        value = 0.5*np.dot(y, alpha) + np.sum(np.log(np.diag(factor[0]))) + \
+                0.5*n*np.log(2*np.pi)
+
+        # K^-1 from the factor, which LAPACK only fills the lower half of
+        inverse, info = dpotri(factor[0], lower=1)
+        inverse = np.tril(inverse) + np.tril(inverse, -1).T
+
+        # d(value)/d(theta) = -1/2 tr((alpha alpha^T - K^-1) dK/dtheta)
+        W = inverse - np.outer(alpha, alpha)
+        dE = signalVariance*E
+        gradient = 0.5*np.array([
+            np.sum(W*dE*self.D2)/lengthScale**2,
+            np.sum(W*dE),
+            noiseVariance*np.trace(W)])
+
+        return value, gradient
+
+    # Kernel matrix and factor of [begin, end) from those of the last window,
+    # when the hyperparameters are fixed and the window slid forward
+    def slide(self, begin, end):
+        removed = begin - self.begin
+        kept = self.end - begin
+        noiseVariance = self.noiseVariance()
+
+        # Remove the samples that slid out of the window
+        K = self.K[removed:,removed:]
+
+        if removed == 0:
+            L = self.L
+        elif kept >= self.minUpdateSize and \
+                removed <= self.maxUpdateFraction*kept:
+            L = choleskyRemoveLeading(self.L[removed:,removed:],
+                    self.L[removed:,:removed])
+            self.updates += 1
+        else:
+            L = np.linalg.cholesky(K)
+
+        # Append the new ones with a block Cholesky step
+        if end > self.end:
+            keptPath = self.path[begin:self.end]
+            newPath = self.path[self.end:end]
+            K21 = self.kernel(newPath, keptPath)
+            K22 = self.kernel(newPath, newPath)
+            K22[np.diag_indices(len(newPath))] += noiseVariance
+
+            L21 = solve_triangular(L, K21.T, lower=True,
+                    check_finite=False).T
+            L22 = np.linalg.cholesky(K22 - np.dot(L21, L21.T))
+
+            K = np.block([[K, K21.T], [K21, K22]])
+            L = np.block([[L, np.zeros((kept, len(newPath)))], [L21, L22]])
+            self.computed += (end - begin)**2 - kept**2
+
+        self.reused += kept**2
+        self.begin, self.end, self.K, self.L = begin, end, K, L
+
+    # Fit the GP to the samples [begin, end)
+    def fit(self, begin, end):
+        if end - begin < 2:
+            raise ValueError("Need at least two samples to fit the GP")
+
+        y = self.measurements[begin:end]
+        self.mean = np.mean(y)
+        y = y - self.mean
+
+        try:
+            if not self.optimize and self.L is not None and \
+                    self.begin <= begin < self.end <= end:
+                self.slide(begin, end)
+            else:
+                self.distances(begin, end)
+
+                if self.logParams is None:
+                    self.logParams = self.guess(y)
+
+                if self.optimize:
+                    result = minimize(self.negLogLikelihood, self.logParams,
+                            args=(y,), jac=True, method='L-BFGS-B',
+                            bounds=self.logBounds,
+                            options={'maxiter': self.maxIter})
+
+                    if np.all(np.isfinite(result.x)) and \
+                            np.isfinite(result.fun):
+                        self.logParams = result.x
+
+                    self.iterations = result.nit
+
+                lengthScale, signalVariance, noiseVariance = \
+                        np.exp(self.logParams)
+                self.K = signalVariance*np.exp(-self.D2/(2*lengthScale**2))
+                self.K[np.diag_indices(end - begin)] += noiseVariance
+                self.L = np.linalg.cholesky(self.K)
+        except np.linalg.LinAlgError:
+            self.L = None
+            raise ValueError("Kernel matrix isn't positive definite")
+
+        # With fixed hyperparameters, the distances are only needed for the
+        # first guess, so they aren't kept up to date
+        if not self.optimize:
+            self.D2 = None
+
+        self.alpha = cho_solve((self.L, True), y, check_finite=False)
+        self.value = 0.5*np.dot(y, self.alpha) + \
+                np.sum(np.log(np.diag(self.L))) + \
+                0.5*len(y)*np.log(2*np.pi)
+
+        return self
+
+    # Log marginal likelihood per sample of the last fit, like
+    # logLikelihoodGPR
+    def logLikelihood(self):
+        return -self.value/(self.end - self.begin)
+
+    # Predict at the [x,y] points, like scikit-learn's GaussianProcess
+    # predict(), so this works with predictGrid and LazySigma
+    def predict(self, X, eval_MSE=False):
+        k = self.kernel(X, self.path[self.begin:self.end])
+        prediction = np.dot(k, self.alpha) + self.mean
+
+        if eval_MSE:
+            v = solve_triangular(self.L, k.T, lower=True, check_finite=False)
+            MSE = np.maximum(self.signalVariance() - np.sum(v**2, axis=0), 0)
+            return prediction, MSE
+
+        return prediction
+
+#
+# Get the thermal from the current window of a fit SlidingWindowGPR, like
+# ThermalGPR
+#
+def ThermalSlidingGPR(engine, extent=10, points=50, chunkSize=2500):
+    path = engine.path[engine.begin:engine.end]
+    grid, grid_x, grid_y = makeGrid(predictionBounds(path, extent), points)
+    prediction = predictGrid(engine, grid, eval_MSE=False, chunkSize=chunkSize)
+
+    return GPRtoThermal(grid, prediction, LazySigma(engine, grid))
@@ -0,0 +1,132 @@
+#
+# Pick which samples to run GPR on
+#
+# When circling, many of the most recent samples are nearly on top of each
+# other, so rather than just taking the last n, these pick n samples that are
+# spread out over the area while still preferring recent ones.
+#
+# Each returns the indices of the samples to use, in their original order.
+#
+
+import numpy as np
+
+#
+# Recency weight of each sample, 1 for the newest and decreasing
+# exponentially with age, or all ones if timeScale is None
+#
+def recencyWeights(times, timeScale):
+    if timeScale is None or times is None:
+        return None
+
+    times = np.asarray(times, dtype=float)
+    return np.exp(-(np.max(times) - times)/timeScale)
+
+#
+# Voxel-grid thinning: keep only the newest sample in each cellSize meter cell
+#
+def voxelThin(path, cellSize):
+    cells = np.floor(np.asarray(path)/cellSize).astype(np.int64)
+
+    # np.unique returns the first of each, so look at them newest first
+    reverse = cells[::-1]
+    _, first = np.unique(reverse, axis=0, return_index=True)
+
+    return np.sort(len(cells) - 1 - first)
+
+#
+# Farthest-point sampling: start with the newest sample, then repeatedly add
+# the one farthest from all the ones picked so far. With a timeScale, the
+# distances are weighted by recency so older samples need to be farther away.
+#
+def farthestPointSample(path, n, times=None, timeScale=None):
+    path = np.asarray(path, dtype=float)
+
+    if n >= len(path):
+        return np.arange(len(path))
+
+    weights = recencyWeights(times, timeScale)
+    selected = np.empty(n, dtype=int)
+    selected[0] = len(path) - 1 if times is None else np.argmax(times)
+
+    # Distance of each sample to the closest one picked so far
+    distance = np.sqrt(np.sum((path - path[selected[0]])**2, axis=1))
+
+    for i in range(1, n):
+        score = distance if weights is None else distance*weights
+        selected[i] = np.argmax(score)
+        distance = np.minimum(distance,
+                np.sqrt(np.sum((path - path[selected[i]])**2, axis=1)))
+
+    return np.sort(selected)
+
+#
+# Greedy max-variance: repeatedly add the sample where a GP with a
+# squared-exponential kernel fit to the ones picked so far is the most
+# uncertain, i.e. a pivoted Cholesky decomposition of the kernel matrix.
+# With a timeScale, the variances are weighted by recency.
+#
+# LengthScale - kernel length scale in meters
+# Nugget - noise variance relative to the kernel's variance
+#
+def maxVarianceSample(path, n, lengthScale=20.0, nugget=1e-2, times=None,
+        timeScale=None):
+    path = np.asarray(path, dtype=float)
+
+    if n >= len(path):
+        return np.arange(len(path))
+
+    weights = recencyWeights(times, timeScale)
+    selected = np.empty(n, dtype=int)
+
+    # Posterior variance of each sample and the Cholesky columns so far
+    variance = np.ones(len(path))
+    L = np.zeros((len(path), n))
+
+    for i in range(n):
+        score = variance if weights is None else variance*weights
+        p = np.argmax(score)
+        selected[i] = p
+
+        # New column of the Cholesky factor of the kernel matrix (plus the
+        # nugget at the pivot) for the samples picked so far
+        k = np.exp(-np.sum((path - path[p])**2, axis=1)/(2*lengthScale**2))
+        column = (k - np.dot(L[:,:i], L[p,:i]))/np.sqrt(variance[p] + nugget)
+        L[:,i] = column
+        variance = np.maximum(variance - column**2, 0)
+        variance[selected[:i+1]] = 0
+
+    return np.sort(selected)
+
+#
+# Pick n of the [t,x,y] samples with one of the above methods: 'recent' (the
+# last n), 'voxel', 'farthest', or 'variance'
+#
+# For 'voxel', the cell size is grown until there are at most 2n cells, then
+# the newest n of those are used.
+#
+def selectSamples(timepos, n, method='farthest', timeScale=None, **kwargs):
+    timepos = np.asarray(timepos)
+    times = timepos[:,0]
+    path = timepos[:,1:3]
+
+    if n >= len(timepos):
+        return np.arange(len(timepos))
+
+    if method == 'recent':
+        return np.arange(len(timepos)-n, len(timepos))
+    elif method == 'voxel':
+        cellSize = kwargs.get('cellSize', 1.0)
+        indices = voxelThin(path, cellSize)
+
+        while len(indices) > 2*n:
+            cellSize *= 1.5
+            indices = voxelThin(path, cellSize)
+
+        return indices[-n:]
+    elif method == 'farthest':
+        return farthestPointSample(path, n, times, timeScale)
+    elif method == 'variance':
+        return maxVarianceSample(path, n, times=times, timeScale=timeScale,
+                **kwargs)
+    else:
+        raise ValueError("Unknown sample selection method: %s" % method)
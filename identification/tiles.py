@@ -0,0 +1,153 @@
+#
+# Split a large area into tiles with a small GP for each, so that long flights
+# covering kilometers don't require one huge GP over the whole area
+#
+
+import numpy as np
+
+from identification.gpr import fitGPR, rotatePoints, predictionBounds, \
+    makeGrid, GPRtoThermal
+
+#
+# Tiled GPR
+#
+# The tiles are tileSize meters on a side. Each tile's GP is fit to the samples
+# within one tile size of its center, i.e. its own tile and half of each
+# neighboring tile. Then a point is always between the centers of four tiles
+# that were fit to the samples around it, and we blend those four predictions
+# with bilinear weights so there are no jumps at tile boundaries.
+#
+# Only the tiles that got new samples since the last fit() are refit, so the
+# cost of an update depends on how many samples are near the new ones rather
+# than on how long we've been flying.
+#
+# MaxSamples - keep at most this many of the most recent samples per tile
+# MinSamples - don't fit a tile's GP until it has at least this many samples
+#
+class TiledGPR:
+    def __init__(self, gprParams, tileSize=200, maxSamples=200, minSamples=10):
+        self.gprParams = gprParams
+        self.tileSize = tileSize
+        self.maxSamples = maxSamples
+        self.minSamples = minSamples
+
+        # (i, j) -> [x,y] samples, measurements, and the fit GP for that tile
+        self.paths = {}
+        self.measurements = {}
+        self.models = {}
+
+        # Tiles that have new samples since they were last fit
+        self.dirty = set()
+
+    # Index (i, j) of the tile with the center just below and to the left of
+    # each point, i.e. the first of the four tiles blended at that point
+    def lowerTile(self, path):
+        return np.floor(path/self.tileSize - 0.5).astype(int)
+
+    # Add new samples to the tiles they're in. Timepos is [t,x,y] like GPR.
+    def update(self, timepos, measurements):
+        path = np.asarray(timepos)[:,1:3]
+        measurements = np.asarray(measurements).reshape(-1)
+        lower = self.lowerTile(path)
+
+        # Each sample is in the region of the four tiles around it
+        for offset in [(0,0), (0,1), (1,0), (1,1)]:
+            keys = lower + offset
+            tiles, inverse = np.unique(keys, axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+
+            for i, tile in enumerate(tiles):
+                key = tuple(tile)
+                inTile = inverse == i
+
+                if key in self.paths:
+                    newPath = np.vstack((self.paths[key], path[inTile]))
+                    newMeasurements = np.concatenate((self.measurements[key],
+                        measurements[inTile]))
+                else:
+                    newPath = path[inTile]
+                    newMeasurements = measurements[inTile]
+
+                self.paths[key] = newPath[-self.maxSamples:]
+                self.measurements[key] = newMeasurements[-self.maxSamples:]
+                self.dirty.add(key)
+
+    # Refit the GPs of the tiles that have new samples
+    def fit(self):
+        for key in self.dirty:
+            if len(self.measurements[key]) < self.minSamples:
+                continue
+
+            try:
+                self.models[key] = fitGPR(self.paths[key],
+                        self.measurements[key], self.gprParams)
+            except ValueError:
+                # Keep using the previous fit for this tile if there is one
+                print("Error: ValueError, couldn't run GPR for tile", key)
+
+        self.dirty = set()
+
+    # Predict at the [x,y] points by blending the tiles around each point
+    #
+    # Points not near any fit tile are NaN.
+    def predict(self, points, eval_MSE=True):
+        n = points.shape[0]
+        lower = self.lowerTile(points)
+        u = points/self.tileSize - 0.5
+
+        weights = np.zeros(n)
+        mean = np.zeros(n)
+        second = np.zeros(n)
+
+        if self.gprParams.angle is not None:
+            points_kernel = rotatePoints(points, self.gprParams.angle)
+        else:
+            points_kernel = points
+
+        for key, gp in self.models.items():
+            # Points for which this is one of the four surrounding tiles
+            offset = np.asarray(key) - lower
+            near = np.all((offset == 0) | (offset == 1), axis=1)
+
+            if not np.any(near):
+                continue
+
+            # Bilinear weight, 1 at this tile's center and 0 at its neighbors'
+            w = np.prod(1 - np.abs(u[near] - key), axis=1)
+
+            if eval_MSE:
+                prediction, MSE = gp.predict(points_kernel[near], eval_MSE=True)
+                second[near] += w*np.asarray(MSE).reshape(-1)
+            else:
+                prediction = gp.predict(points_kernel[near])
+
+            prediction = np.asarray(prediction).reshape(-1)
+            weights[near] += w
+            mean[near] += w*prediction
+            second[near] += w*prediction**2
+
+        # Normalize for where some of the four tiles don't have a fit yet
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean /= weights
+            second /= weights
+
+        if eval_MSE:
+            # Variance of the mixture of the tiles' predictions
+            sigma = np.sqrt(np.maximum(second - mean**2, 0))
+            return mean, sigma
+
+        return mean
+
+#
+# Get thermal from the tiled GPR over the bounding box of the given [t,x,y]
+# samples, e.g. the most recent ones, rather than over the whole area
+#
+def ThermalTiledGPR(tiled, timepos, extent=10, points=50):
+    path = np.asarray(timepos)[:,1:3]
+    grid, grid_x, grid_y = makeGrid(predictionBounds(path, extent), points)
+    prediction, sigma = tiled.predict(grid)
+
+    # Ignore points that no tile covers
+    prediction = np.where(np.isnan(prediction), -np.inf, prediction)
+
+    return GPRtoThermal(grid, prediction, sigma)
@@ -0,0 +1,106 @@
+#
+# Track the thermal between GPR fits, so we can keep updating where to orbit
+# while waiting for the next fit
+#
+
+import numpy as np
+
+#
+# Constant-velocity Kalman filter on the thermal center and strength
+#
+# The state is [x, y, vx, vy, strength], with x and y in meters in a fixed
+# frame. Each GPR fit is a measurement of [x, y, strength]. In between, the
+# center drifts at the estimated velocity, e.g. with the wind, and the
+# uncertainty grows.
+#
+# PositionNoise - standard deviation in meters of the GPR center, about the
+#     grid spacing
+# DriftNoise - how much in m/s^2 the drift velocity may change
+# StrengthNoise - how much in (m/s)/sqrt(s) the strength may change
+# InitialVelocity - standard deviation in m/s of the drift before we've seen
+#     the thermal move
+# Gate - if a fit is further than this (squared Mahalanobis distance) from
+#     where we think the thermal is, it's probably a different thermal, so
+#     start over at the new one. Default is the 99% value for 3 dimensions.
+#
+class ThermalTracker:
+    def __init__(self, positionNoise=5.0, driftNoise=0.1, strengthNoise=0.05,
+                 initialVelocity=2.0, gate=11.34):
+        self.positionNoise = positionNoise
+        self.driftNoise = driftNoise
+        self.strengthNoise = strengthNoise
+        self.initialVelocity = initialVelocity
+        self.gate = gate
+
+        # We only measure the position and strength
+        self.H = np.zeros((3, 5))
+        self.H[0,0] = self.H[1,1] = self.H[2,4] = 1
+
+        self.reset()
+
+    # Forget the thermal, e.g. when the GPR says we're not in one anymore
+    def reset(self):
+        self.state = None
+        self.P = None
+        self.t = None
+
+    # Whether we're tracking a thermal
+    def tracking(self):
+        return self.state is not None
+
+    # State transition and process noise for a time step of dt seconds
+    def transition(self, dt):
+        F = np.eye(5)
+        F[0,2] = F[1,3] = dt
+
+        # Continuous white-noise acceleration for the position and velocity
+        # of each axis, and a random walk for the strength
+        q = self.driftNoise**2
+        Q = np.zeros((5, 5))
+        Q[[0,1],[0,1]] = q*dt**3/3
+        Q[[0,1],[2,3]] = Q[[2,3],[0,1]] = q*dt**2/2
+        Q[[2,3],[2,3]] = q*dt
+        Q[4,4] = self.strengthNoise**2*dt
+
+        return F, Q
+
+    # Where we think the thermal is at time t, without changing the state
+    #
+    # Returns (x, y, strength, uncertainty) like GPRtoThermal, or None if
+    # we're not tracking a thermal.
+    def predict(self, t):
+        if not self.tracking():
+            return None
+
+        F, Q = self.transition(max(t - self.t, 0))
+        state = np.dot(F, self.state)
+        P = np.dot(np.dot(F, self.P), F.T) + Q
+
+        return state[0], state[1], state[4], np.sqrt(P[4,4])
+
+    # Add the thermal found with GPR at time t
+    def update(self, t, x, y, strength, uncertainty):
+        z = np.array([x, y, strength], dtype=float)
+        R = np.diag([self.positionNoise**2, self.positionNoise**2,
+            max(float(uncertainty), 1e-6)**2])
+
+        if self.tracking():
+            F, Q = self.transition(max(t - self.t, 0))
+            state = np.dot(F, self.state)
+            P = np.dot(np.dot(F, self.P), F.T) + Q
+
+            innovation = z - np.dot(self.H, state)
+            S = np.dot(np.dot(self.H, P), self.H.T) + R
+
+            if np.dot(innovation, np.linalg.solve(S, innovation)) <= self.gate:
+                K = np.linalg.solve(S, np.dot(self.H, P)).T
+                self.state = state + np.dot(K, innovation)
+                self.P = np.dot(np.eye(5) - np.dot(K, self.H), P)
+                self.t = t
+                return
+
+        # Start tracking this thermal
+        self.state = np.array([x, y, 0, 0, strength], dtype=float)
+        self.P = np.diag([R[0,0], R[1,1], self.initialVelocity**2,
+            self.initialVelocity**2, R[2,2]])
+        self.t = t
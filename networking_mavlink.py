@@ -28,6 +28,17 @@ class NetworkingThreadSend(threading.Thread):
         # Used to tell when to exit this thread
         self.exiting = False
 
+    # Set the mode if we're not already in it
+    #
+    # This checks the mode the vehicle reports in its heartbeats, which
+    # pymavlink keeps in master.flightmode, rather than the last one we asked
+    # for, since set_mode isn't acknowledged. Then if the message is dropped or
+    # a failsafe or the pilot changes the mode, we set it again with the next
+    # command.
+    def setMode(self, mode):
+        if mode != self.master.flightmode:
+            self.master.set_mode(mode)
+
     def run(self):
         while not self.exiting:
             # Wait till we get a command
@@ -67,7 +78,7 @@ class NetworkingThreadSend(threading.Thread):
 
                     # Set us to be in the mode to actually fly to it rather than
                     # continuing on the current mission / flight plan
-                    self.master.set_mode('GUIDED')
+                    self.setMode('GUIDED')
 
                     print("Orbiting, Prediction:", c["prediction"], "Uncertainty:",
                             c["uncertainty"], "AGL:", AGL)
@@ -75,7 +86,7 @@ class NetworkingThreadSend(threading.Thread):
                     print("Skipping, Uncertainty:", c["uncertainty"],
                             "AGL:", AGL, "StopAlt:", stopAlt)
                     # Continue on normal flight plan
-                    self.master.set_mode('AUTO')
+                    self.setMode('AUTO')
 
     def stop(self):
         self.exiting = True
@@ -3,40 +3,75 @@
 # simulation data, rather than live connected to the simulator
 #
 
+import argparse
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
 
 from identification.bayesian import BayesianLearning
-from identification.gpr import GPRParams, ThermalGPRPlot
-from identification.data import windowSubset, shrinkSamples, readData, \
+from identification.gpr import GPRParams, ThermalGPR, ThermalGPRPlot
+from identification.data import timeWindowBounds, decimateTimes, readData, \
     compareXYLatLong, xyToLatLong
+from identification.cache import ConvertedLog, loadConvertedLog
+from identification.incremental import SlidingWindowGPR, ThermalSlidingGPR
+
+#
+# Times of the samples in seconds, either the converted time or the raw
+# SystemTime in milliseconds
+#
+def logTimes(df):
+    if isinstance(df, ConvertedLog):
+        return df['time']
+
+    return df['SystemTime'].values*1e-3
+
+#
+# Get a window of the data converted to X-Y, by default starting at zero
+#
+# Start and duration are in seconds, and we take about one sample every
+# interval seconds.
+#
+# If df is a ConvertedLog from loadConvertedLog, this just takes the window out
+# of the already-converted data. Otherwise, it converts the window with
+# readData.
+#
+def readWindow(df, start, duration, interval, startAtZero=True):
+    times = logTimes(df)
+    begin, end = timeWindowBounds(times, start, duration)
+
+    if isinstance(df, ConvertedLog):
+        return df.dataFrame(begin, end-begin, startAtZero=startAtZero,
+                interval=interval)
+
+    df_subset = df.iloc[begin + decimateTimes(times[begin:end], interval), :]
+
+    return readData(df_subset, startAtZero=startAtZero)
 
 #
 # Process the data using batch processing over a certain window size. This is an
 # approach that some papers have used.
 #
+# df - the simulator data, either a DataFrame or a ConvertedLog
 # slidingWindow - Process the data in batch sliding window sizes of a certain number
 #     of seconds
 # slideBy - Slide by a certain number of seconds for each subsequent iteration
-# shrinkSampleSize - Take only every nth sample rather than all the data in this
-#     sliding window, needed to speed up GPR and make it use less memory
-# dataFrequency - The frequency in Hz that the data has been recored ata.
+# sampleInterval - Take only about one sample every this many seconds rather
+#     than all the data in this sliding window, needed to speed up GPR and make
+#     it use less memory
 # limitWindows - which windows to run with, all by default, otherwise specify
 #     e.g., [0,3,5]
 #
-def batchProcessing(df, slidingWindow=30, slideBy=15,
-                    shrinkSampleSize=10, dataFrequency=25,
+def batchProcessing(df, slidingWindow=30, slideBy=15, sampleInterval=0.4,
                     limitWindows=None):
-    # How many samples we've recored
-    length = df.shape[0]
-
-    # Convert from seconds to samples
-    slidingWindowSizeInSamples = slidingWindow * dataFrequency
-    slideByInSamples = slideBy * dataFrequency
+    # How long we've recorded, from the time column rather than assuming a
+    # data frequency
+    times = logTimes(df)
+    firstTime, lastTime = times[0], times[-1]
 
     # How many sliding windows will we be able to have?
-    slidingWindows = np.floor(length/slideByInSamples)
+    slidingWindows = np.floor((lastTime - firstTime)/slideBy)
 
     # Run GPR on each sliding window
     for i in range(0, int(slidingWindows)):
@@ -44,17 +79,15 @@ def batchProcessing(df, slidingWindow=30, slideBy=15,
             continue
 
         # Limit the input data for only our sliding window
-        start = slideByInSamples*i
-        size = slidingWindowSizeInSamples
-        df_subset = windowSubset(df, start, size)
-        df_subset = shrinkSamples(df_subset, shrinkSampleSize)
+        start = firstTime + slideBy*i
 
         print()
-        print("Sliding window #", i, " for samples ", start, " to ", start+size, sep="")
+        print("Sliding window #", i, " for times ", start, " to ",
+                start+slidingWindow, " s", sep="")
         print()
 
         # Compute Lat-Long to X-Y for this sliding window
-        data, lat_0 = readData(df_subset, startAtZero=True)
+        data, lat_0 = readWindow(df, start, slidingWindow, sampleInterval)
 
         # Look at the flight path in this window
         #compareXYLatLong(data, latlong=False)
@@ -76,7 +109,177 @@ def batchProcessing(df, slidingWindow=30, slideBy=15,
 
         plt.show()
 
+#
+# A plain float from a value that may be a one-element array, e.g. the
+# prediction at the thermal, which is (1,) since the measurements are (n,1)
+#
+def scalar(value):
+    return float(np.ravel(value)[0])
+
+#
+# Fit GPR to one sliding window without plotting, run in a worker process
+#
+# The log is a ConvertedLog, so only its directory is sent to the worker and
+# the columns are memory mapped there rather than copied.
+#
+# Returns a row of the results table, with NaNs if GPR failed.
+#
+def fitWindow(log, i, start, duration, interval, gprParams, extent, points):
+    # Not starting at zero, so X-Y is relative to the log's lat_0
+    data, lat_0 = readWindow(log, start, duration, interval, startAtZero=False)
+    measurements = np.array(data[['VelDown']])
+    timepos = np.array(data[['time', 'x', 'y']])
+
+    startTime = perf_counter()
+
+    try:
+        x, y, prediction, uncertainty = map(scalar, ThermalGPR(timepos,
+            measurements, gprParams, extent, points))
+        lat, lon = xyToLatLong(x, y, lat_0)
+    except ValueError:
+        x = y = lat = lon = prediction = uncertainty = np.nan
+
+    return {
+        'window': i,
+        'start': start,
+        'end': start+duration,
+        'samples': len(data),
+        'x': x,
+        'y': y,
+        'lat': lat,
+        'lon': lon,
+        'prediction': prediction,
+        'uncertainty': uncertainty,
+        'fitTime': perf_counter() - startTime,
+    }
+
+#
+# Like batchProcessing but non-interactive, running all the sliding windows in
+# parallel on maxWorkers processes (all the cores by default)
+#
+# log - a ConvertedLog from loadConvertedLog
+#
+# Returns a DataFrame with one row per window of where the thermal is, how
+# strong and certain it is, and how long the fit took.
+#
+def batchProcessingParallel(log, slidingWindow=30, slideBy=15,
+        sampleInterval=0.4, limitWindows=None, gprParams=None, extent=0,
+        points=200, maxWorkers=None):
+    if gprParams is None:
+        gprParams = GPRParams(theta0=1e-2, thetaL=1e-10, thetaU=1e10,
+                nugget=1, random_start=10)
+
+    times = logTimes(log)
+    firstTime, lastTime = times[0], times[-1]
+    slidingWindows = int(np.floor((lastTime - firstTime)/slideBy))
+    windows = [i for i in range(slidingWindows)
+            if not limitWindows or i in limitWindows]
+
+    with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+        futures = [executor.submit(fitWindow, log, i, firstTime + slideBy*i,
+            slidingWindow, sampleInterval, gprParams, extent, points)
+            for i in windows]
+        results = [future.result() for future in futures]
+
+    return pd.DataFrame(results, columns=['window', 'start', 'end',
+        'samples', 'x', 'y', 'lat', 'lon', 'prediction', 'uncertainty',
+        'fitTime'])
+
+#
+# Like batchProcessingParallel, but running the windows in order on one
+# SlidingWindowGPR. With optimize=False, the hyperparameters are guessed from
+# the first window and the kernel matrix and its factor are updated from one
+# window to the next, which is for dense sweeps where slideBy is much smaller
+# than slidingWindow. With optimize=True, each window is fit starting from the
+# last window's hyperparameters, which saves much less.
+#
+# This isn't the same GP model as batchProcessingParallel (see
+# identification/incremental.py), so compare results from one or the other,
+# not between them.
+#
+# The log is decimated once to about one sample every sampleInterval seconds
+# so that overlapping windows have exactly the same samples.
+#
+def batchProcessingIncremental(log, slidingWindow=30, slideBy=15,
+        sampleInterval=0.4, limitWindows=None, extent=0, points=200,
+        optimize=True):
+    times = logTimes(log)
+    index = decimateTimes(times, sampleInterval)
+    times = np.asarray(times[index])
+    path = np.vstack((log['x'][index], log['y'][index])).T
+    engine = SlidingWindowGPR(path, log['VelDown'][index], optimize=optimize)
+
+    firstTime, lastTime = times[0], times[-1]
+    slidingWindows = int(np.floor((lastTime - firstTime)/slideBy))
+    results = []
+
+    for i in range(slidingWindows):
+        if limitWindows and i not in limitWindows:
+            continue
+
+        start = firstTime + slideBy*i
+        begin, end = timeWindowBounds(times, start, slidingWindow)
+        startTime = perf_counter()
+
+        try:
+            engine.fit(begin, end)
+            x, y, prediction, uncertainty = map(scalar,
+                    ThermalSlidingGPR(engine, extent, points))
+            lat, lon = xyToLatLong(x, y, log.lat_0)
+        except ValueError:
+            x = y = lat = lon = prediction = uncertainty = np.nan
+
+        results.append({
+            'window': i,
+            'start': start,
+            'end': start+slidingWindow,
+            'samples': int(end-begin),
+            'x': x,
+            'y': y,
+            'lat': lat,
+            'lon': lon,
+            'prediction': prediction,
+            'uncertainty': uncertainty,
+            'fitTime': perf_counter() - startTime,
+        })
+
+    return pd.DataFrame(results, columns=['window', 'start', 'end',
+        'samples', 'x', 'y', 'lat', 'lon', 'prediction', 'uncertainty',
+        'fitTime'])
+
 if __name__ == "__main__":
-    # Let's do this thing
-    df = pd.read_csv('../bayesian-learning/gaussian-process-regression/run9.csv')
-    batchProcessing(df, slidingWindow=45, slideBy=45, limitWindows=[4,5])
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', nargs='?',
+        default='../bayesian-learning/gaussian-process-regression/run9.csv',
+        help="simulator CSV log")
+    parser.add_argument('--batch', metavar='RESULTS.csv',
+        help="run all windows in parallel without plotting and save a table "
+             "of the thermals found")
+    parser.add_argument('--workers', type=int, default=None,
+        help="number of processes for --batch, default is one per core")
+    parser.add_argument('--incremental', action='store_true',
+        help="with --batch, run the windows in order on a sliding-window GP "
+             "rather than in parallel; not the same model, so results aren't "
+             "comparable with the parallel ones")
+    parser.add_argument('--fixed', action='store_true',
+        help="with --incremental, keep the hyperparameters guessed from the "
+             "first window and update the kernel factor between windows")
+    parser.add_argument('--slide', type=float, default=45,
+        help="seconds to slide each window by in --batch mode")
+    args = parser.parse_args()
+
+    # Let's do this thing, only converting the log the first time
+    df = loadConvertedLog(args.filename)
+
+    if args.batch:
+        if args.incremental:
+            results = batchProcessingIncremental(df, slidingWindow=45,
+                    slideBy=args.slide, optimize=not args.fixed)
+        else:
+            results = batchProcessingParallel(df, slidingWindow=45,
+                    slideBy=args.slide, maxWorkers=args.workers)
+
+        results.to_csv(args.batch, index=False)
+        print(results.to_string(index=False))
+    else:
+        batchProcessing(df, slidingWindow=45, slideBy=45, limitWindows=[4,5])
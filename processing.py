@@ -4,16 +4,235 @@
 
 import json
 import numpy as np
-from time import sleep
+from time import sleep, time
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 
-from identification.data import xyToLatLong, readNetworkData, shrinkSamples
-from identification.gpr import GPRParams, ThermalGPR, ThermalGPRPlot
+from identification.data import latLongToXY, readNetworkArrays, LocalFrame, \
+    TelemetryCleaner
+from identification.gpr import GPRParams, GridCache, GPR, GPRtoThermals, \
+    ThermalGPR, ThermalGPRPlot, logLikelihoodGPR, heuristicGPRParams
+from identification.tracking import ThermalTracker
+from identification.selection import selectSamples
+
+# Window sizes in samples that we fit at the same time. The short windows
+# respond faster to new thermals, and the long ones are more stable.
+windowSizes = [50, 100, 250]
+
+# Rather than the last so many samples, each window picks its samples out of
+# this many times as many recent ones, spread out over the area since many of
+# the recent ones are nearly on top of each other when circling. Older samples
+# are weighted less with this time scale in seconds.
+selectionFactor = 3
+selectionMethod = 'farthest'
+selectionTimeScale = 20.0
+
+# Merge samples within about this many meters of each other by averaging them,
+# since near duplicates make the GP's covariance matrix ill-conditioned
+dedupTolerance = 1.0
+
+# Drop GPS glitches faster than this many m/s and altitudes outside this range
+# in meters before fitting
+maxSpeed = 50.0
+altitudeRange = (-500.0, 10000.0)
+
+# How long in seconds to wait for the fits after starting them. Fits that
+# aren't done by then are discarded.
+deadline = 5.0
+
+# How often in seconds to send a command to the autopilot, whether or not a
+# new fit has finished. Between fits, the thermal tracker predicts where the
+# thermal has drifted to, so this can be as fast as the telemetry.
+commandPeriod = 0.5
+
+# The bounds of the last so many points barely move between iterations, so
+# snap them to a 10 m lattice to reuse the same prediction grid. The windows
+# cover different areas, so each window size gets its own cache, otherwise a
+# worker fitting one size after another would replace the grid every time.
+# Each worker process has its own copy of these.
+gridCaches = {}
+
+#
+# The grid cache for a window size. Until we have enough data for all of them,
+# the windows are smaller, and they use the cache of the next larger window
+# size so we only ever have one per window size.
+#
+def windowGridCache(windowSize):
+    key = min([size for size in windowSizes if size >= windowSize],
+            default=windowSize)
+
+    if key not in gridCaches:
+        gridCaches[key] = GridCache(lattice=10)
+
+    return gridCaches[key]
+
+#
+# Fit GPR to one window of data, run in a worker process
+#
+# Returns the window size, all the thermals we're confident in (most certain
+# first), the log likelihood per sample to compare windows with, and how long
+# it took, or None if GPR failed.
+#
+def fitWindow(windowSize, timepos, measurements, gprParams):
+    start = time()
+
+    try:
+        (grid, grid_x, grid_y), prediction, sigma = GPR(timepos, measurements,
+                gprParams, extent=10, points=50,
+                gridCache=windowGridCache(windowSize), eval_MSE=False)
+    except ValueError:
+        print("Error: ValueError, couldn't run GPR on window of", windowSize)
+        return None
+
+    thermals = GPRtoThermals(grid, grid_x.shape, prediction, sigma,
+            z=1.9600/2, minLift=0.5)
+
+    # LazySigma keeps the fit GP
+    score = logLikelihoodGPR(sigma.gp)
+
+    return windowSize, thermals, score, time() - start
+
+#
+# Create the command to send to the autopilot
+#
+# Estimate is (lat, lon, prediction, uncertainty) of the thermal or None if
+# we're not in one. Tier is the quality of the estimate:
+#  - fit: from GPR fits that finished since the last command
+#  - tracked: where the thermal tracker predicts the thermal from the last
+#    GPR fits has drifted to, since the new ones aren't done yet
+#  - last: from the last GPR fits, which didn't find a thermal
+#  - coarse: a quick fixed-theta solve on a coarse grid, since we don't have
+#    any GPR fits yet
+#
+def thermalCommand(estimate, networkData, tier):
+    # Go back to the normal flight plan if we're not predicting with
+    # 97.5% confidence that we have an upwards vertical velocity
+    # (or if /2, then 83.6% confidence)
+    #
+    # Or, if it's imaginary
+    #if not np.isreal(prediction) or prediction-1.9600*uncertainty <= 0:
+    if estimate is None or not np.isreal(estimate[2]) or \
+            estimate[2]-1.9600/2*estimate[3] <= 0.5:
+        return {
+            "type": "command",
+            "date": str(datetime.now()),
+            "lat": 0,
+            "lon": 0,
+            "alt": 0,
+            "radius": 0,
+            "prediction": float(0),
+            "uncertainty": float(-1), # Magic value meaning we're not in a thermal
+            "tier": tier
+            }
+
+    # If we do think we're in a thermal, send real data
+    lat, lon, prediction, uncertainty = estimate
+
+    # Calculate average altitude from last 45 seconds
+    s = 0
+    for d in networkData:
+        s += d["alt"]
+    avgAlt = s / len(networkData)
+
+    # Send a new orbit and radius
+    return {
+        "type": "command",
+        "date": str(datetime.now()),
+        "lat": lat,
+        "lon": lon,
+        "alt": avgAlt,
+        "radius": 10.0, # Can only be in 10 m intervals?
+        "prediction": float(prediction),
+        "uncertainty": float(uncertainty),
+        "tier": tier
+        }
+
+#
+# Only send commands that are different enough from the last one we sent, so
+# we don't make the autopilot fly to a new waypoint every time the predicted
+# center moves a few centimeters
+#
+# Distance - meters the center must move
+# Altitude - meters the altitude must change
+# Confidence - how much the prediction or uncertainty must change
+# Refresh - send the command again anyway after this many seconds
+#
+class CommandFilter:
+    def __init__(self, distance=10.0, altitude=5.0, confidence=0.2,
+                 refresh=10.0):
+        self.distance = distance
+        self.altitude = altitude
+        self.confidence = confidence
+        self.refresh = refresh
+
+        # The last command we sent and when
+        self.last = None
+        self.lastTime = None
+
+        # For debugging, how many commands we sent and didn't send
+        self.sent = 0
+        self.suppressed = 0
+
+    # Whether the command differs enough from the last one to send it
+    def changed(self, command, t):
+        if self.last is None or t - self.lastTime >= self.refresh:
+            return True
+
+        # Always send when we enter or leave a thermal
+        inThermal = command["uncertainty"] != -1
+        wasInThermal = self.last["uncertainty"] != -1
+
+        if inThermal != wasInThermal:
+            return True
+
+        # Nothing changes if we're still not in a thermal
+        if not inThermal:
+            return False
+
+        x, y = latLongToXY(command["lat"], command["lon"], self.last["lat"])
+        lastX, lastY = latLongToXY(self.last["lat"], self.last["lon"],
+                self.last["lat"])
+
+        return np.hypot(x - lastX, y - lastY) > self.distance or \
+            abs(command["alt"] - self.last["alt"]) > self.altitude or \
+            abs(command["prediction"] - self.last["prediction"]) > self.confidence or \
+            abs(command["uncertainty"] - self.last["uncertainty"]) > self.confidence
+
+    # Check the command, and if we should send it, record it as sent
+    def accept(self, command, t=None):
+        if t is None:
+            t = time()
+
+        if self.changed(command, t):
+            self.last = command
+            self.lastTime = t
+            self.sent += 1
+            return True
+
+        self.suppressed += 1
+        return False
+
+#
+# Convert the best thermal from a fit from X/Y in the frame to Lat/Long, or
+# None if there aren't any we're confident in
+#
+def thermalEstimate(thermals, frame):
+    if not thermals:
+        return None
+
+    x, y, prediction, uncertainty = thermals[0]
+    lat, lon = frame.toLatLong(x, y)
+
+    return lat, lon, prediction, uncertainty
 
 #
 # Processing thread, where we do thermal identification
 #
+# This is an anytime loop: every commandPeriod seconds it sends the best
+# estimate we have at that point, while the GPR fits keep running in the
+# background on the process pool.
+#
 def processingProcess(manager, debug):
     # Only show one figure, just update it on key press
     #
@@ -28,105 +247,215 @@ def processingProcess(manager, debug):
     #
     fig = plt.figure(figsize=(10,5))
 
+    # Fit each window size on its own core
+    executor = ProcessPoolExecutor(max_workers=len(windowSizes))
+
+    # Window size -> the last fit we started for it, so we don't start
+    # another one while a fit that missed the deadline is still running
+    running = {}
+
+    # The fits we're waiting on, with when we started them and the data
+    # they're fit to, so we can convert the result to Lat/Long
+    futures = []
+    started = 0
+    startedData = None
+
+    # The best estimate from the last fits and whether we've sent it yet
+    lastEstimate = None
+    haveFit = False
+    newFit = False
+
+    # Follow the thermal between fits
+    tracker = ThermalTracker()
+
+    # Convert positions to X/Y in one fixed frame, so that positions from
+    # different fits, the tracker, and the cached grid all line up
+    frame = None
+
+    # Drop bad samples before they get to GPR
+    cleaner = TelemetryCleaner(maxSpeed, *altitudeRange)
+
+    gprParams = GPRParams(theta0=1e-2, thetaL=1e-10, thetaU=1e10,
+            nugget=1, random_start=10)
+
+    # Don't resend commands that barely changed
+    commandFilter = CommandFilter()
+
+    nextCommand = time()
+
+    # The last so many data points, only fetched when we need newer data, since
+    # each fetch copies the whole buffer out of the manager process
+    networkData = None
+
     while True:
-        # Get the last so many data points
-        networkData = manager.getAllData()
+        # Start new fits if we're not waiting on any, unless every window size
+        # is still busy with a fit that missed the deadline
+        if not futures and (not running or
+                any(f.done() for f in running.values())):
+            # Get the last so many data points
+            networkData = manager.getAllData()
 
-        # We want quite a few points
-        if not networkData:
-            if debug:
-                print("No data yet")
-            sleep(1)
-            continue
+            # We want quite a few points
+            if not networkData:
+                if debug:
+                    print("No data yet")
+                sleep(1)
+                continue
 
-        # We need some data to work with
-        if len(networkData) < 10:
-            if debug:
-                print("Only have", len(networkData))
-            sleep(1)
-            continue
+            # We need some data to work with
+            if len(networkData) < 10:
+                if debug:
+                    print("Only have", len(networkData))
+                sleep(1)
+                continue
+
+            # Put the origin where we first got data with a GPS fix
+            if frame is None:
+                first = next((d for d in networkData
+                    if np.isfinite(d["lat"]) and np.isfinite(d["lon"])
+                    and (d["lat"] or d["lon"])), networkData[0])
+                frame = LocalFrame(first["lat"], first["lon"])
+
+            # Data to run GPR
+            result = readNetworkArrays(networkData, frame, dedupTolerance,
+                    cleaner)
 
-        data, lat_0 = readNetworkData(networkData)
+            if debug and any(cleaner.rejected.values()):
+                print("Rejected samples:", cleaner.rejected)
 
-        # Try to get about 50 points
-        if len(data) > 100:
-            #data = shrinkSamples(data, int(len(data)/50))
-            data = data.iloc[len(data)-100:len(data), :]
+            if result is None:
+                if debug:
+                    print("No good samples yet")
+                sleep(1)
+                continue
 
-        # Run GPR
-        print("Running GPR with", len(data), "points")
+            timepos, measurements, lat_0 = result
 
-        # Data to run GPR
-        timepos = np.array(data[['time', 'x', 'y']])
-        measurements = np.array(data[['energy']])
-        gprParams = GPRParams(theta0=1e-2, thetaL=1e-10, thetaU=1e10,
-                nugget=1, random_start=10)
+            # The number of points for each window, or all of them if we
+            # don't have enough yet
+            sizes = sorted(set(min(size, len(timepos)) for size in windowSizes))
+            windows = {}
 
-        try:
-            # Run GPR
+            # Run GPR on each window that isn't still busy
             if debug:
-                x, y, prediction, uncertainty = ThermalGPRPlot(fig, timepos,
-                        measurements, gprParams, fast=True)
+                print("Running GPR with windows of", sizes, "points")
 
-                # Update the plot
-                plt.ion()
-                plt.draw()
-                plt.waitforbuttonpress(timeout=0.001)
-            else:
-                x, y, prediction, uncertainty = ThermalGPR(timepos, measurements,
+            for size in sizes:
+                if size in running and not running[size].done():
+                    continue
+
+                candidates = len(timepos) - min(selectionFactor*size, len(timepos))
+                windows[size] = candidates + selectSamples(timepos[candidates:],
+                        size, selectionMethod, selectionTimeScale)
+
+                running[size] = executor.submit(fitWindow, size,
+                        timepos[windows[size]], measurements[windows[size]],
                         gprParams)
+                futures.append(running[size])
+
+            started = time()
+            startedData = (timepos, measurements, windows)
+
+        # Once they're all done or we hit the deadline, use the fits that
+        # finished
+        done = [f for f in futures if f.done()]
+
+        if futures and (len(done) == len(futures) or time() - started > deadline):
+            results = [f.result() for f in done if f.result() is not None]
+
+            if debug and len(done) < len(futures):
+                print("Discarding", len(futures)-len(done),
+                        "fits that missed the deadline")
+
+            if results:
+                # Pick the window that best explains its data
+                size, thermals, score, duration = max(results,
+                        key=lambda r: r[2])
+                timepos, measurements, windows = startedData
+                lastEstimate = thermalEstimate(thermals, frame)
+                haveFit = True
+                newFit = True
+
+                if lastEstimate is None:
+                    tracker.reset()
+                else:
+                    x, y, prediction, uncertainty = thermals[0]
+                    tracker.update(started, x, y, prediction, uncertainty)
 
-            # Go back to the normal flight plan if we're not predicting with
-            # 97.5% confidence that we have an upwards vertical velocity
-            # (or if /2, then 83.6% confidence)
-            #
-            # Or, if it's imaginary
-            #if not np.isreal(prediction) or prediction-1.9600*uncertainty <= 0:
-            if not np.isreal(prediction) or prediction-1.9600/2*uncertainty <= 0.5:
-                command = json.dumps({
-                    "type": "command",
-                    "date": str(datetime.now()),
-                    "lat": 0,
-                    "lon": 0,
-                    "alt": 0,
-                    "radius": 0,
-                    "prediction": float(0),
-                    "uncertainty": float(-1) # Magic value meaning we're not in a thermal
-                    })
-
-                # TODO see if the prediction is real!!!???
                 if debug:
-                    print("Prediction:", prediction)
+                    print("Picked window", size, "Score:", score, "Time:",
+                            duration, "Thermals:", len(thermals))
+
+                    # Show the window we picked
+                    try:
+                        ThermalGPRPlot(fig, timepos[windows[size]],
+                                measurements[windows[size]], gprParams,
+                                fast=True, gridCache=windowGridCache(size))
 
-            # If we do think we're in a thermal, send real data
+                        # Update the plot
+                        plt.ion()
+                        plt.draw()
+                        plt.waitforbuttonpress(timeout=0.001)
+                    except ValueError:
+                        print("Error: ValueError, couldn't run GPR")
             else:
-                # Convert X/Y to Lat/Long
-                lat, lon = xyToLatLong(x, y, lat_0)
-
-                # Calculate average altitude from last 45 seconds
-                s = 0
-                for d in networkData:
-                    s += d["alt"]
-                avgAlt = s / len(networkData)
-
-                # Send a new orbit and radius
-                command = json.dumps({
-                    "type": "command",
-                    "date": str(datetime.now()),
-                    "lat": lat,
-                    "lon": lon,
-                    "alt": avgAlt,
-                    "radius": 10.0, # Can only be in 10 m intervals?
-                    "prediction": float(prediction),
-                    "uncertainty": float(uncertainty)
-                    })
-
-            manager.addCommand(command)
+                print("Error: no GPR fits finished before the deadline")
 
-            if debug:
-                print("Sending:", command)
+            futures = []
+
+        # Send the best estimate we have every command period
+        if time() >= nextCommand:
+            if newFit:
+                command = thermalCommand(lastEstimate, networkData, "fit")
+                newFit = False
+            elif tracker.tracking():
+                # Where the thermal is now, so also the current altitude
+                networkData = manager.getAllData()
+                x, y, prediction, uncertainty = tracker.predict(time())
+                lat, lon = frame.toLatLong(x, y)
+                command = thermalCommand((lat, lon, prediction, uncertainty),
+                        networkData, "tracked")
+            elif haveFit:
+                command = thermalCommand(lastEstimate, networkData, "last")
+            else:
+                # No fits yet, so do a quick fixed-theta solve on a coarse grid
+                networkData = manager.getAllData()
+                result = readNetworkArrays(networkData, frame,
+                        dedupTolerance, cleaner)
+
+                try:
+                    if result is None:
+                        raise ValueError("no good samples")
+
+                    timepos, measurements, lat_0 = result
+                    timepos = timepos[-min(windowSizes):]
+                    measurements = measurements[-min(windowSizes):]
+
+                    x, y, prediction, uncertainty = ThermalGPR(timepos,
+                            measurements, heuristicGPRParams(timepos,
+                                measurements, nugget=1), points=15)
+                    lat, lon = frame.toLatLong(x, y)
+                    estimate = (lat, lon, float(np.ravel(prediction)[0]),
+                            float(np.ravel(uncertainty)[0]))
+                except ValueError:
+                    print("Error: ValueError, couldn't run coarse GPR")
+                    estimate = None
+
+                command = thermalCommand(estimate, networkData, "coarse")
+
+            if commandFilter.accept(command):
+                manager.addCommand(json.dumps(command))
+
+                if debug:
+                    print("Sending:", command)
+            elif debug:
+                print("Not sending, sent", commandFilter.sent, "suppressed",
+                        commandFilter.suppressed)
+
+            # If we fell behind, don't try to catch up
+            nextCommand = max(nextCommand + commandPeriod, time())
 
-        except ValueError:
-            print("Error: ValueError, couldn't run GPR")
+        # Wait till the next command or until the fits might be done
+        sleep(max(0, min(nextCommand - time(), 0.05)))
 
     print("Exiting processingProcess")
@@ -0,0 +1,184 @@
+#
+# Run GPR on sliding windows of recorded logs for every combination of a grid
+# of parameters, to tune them without editing offline_gpr.py by hand
+#
+# Each (log, window, parameters) result is saved in the cache directory under
+# a hash of the log's contents and the parameters, so running the sweep again
+# with more values only computes the new combinations.
+#
+# Usage, e.g.:
+#
+# $ python3 sweep.py run9.csv run10.csv --nugget 0.1 1 --theta0 1e-2 1e-1 \
+#       --window 30 45 --interval 0.2 0.4 --points 50 100 -o sweep.csv
+#
+
+import os
+import json
+import hashlib
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from identification.gpr import GPRParams
+from identification.cache import loadConvertedLog
+from offline_gpr import logTimes, fitWindow
+
+# Change this if the results would be different, e.g. fitWindow changes, so
+# that the old cached results aren't used
+sweepVersion = 2
+
+# The parameters we sweep over and the columns they get in the output. The
+# window length in seconds isn't called window since that's the column with
+# the index of each window from fitWindow.
+sweepParameters = ['nugget', 'theta0', 'windowLength', 'interval', 'points']
+
+#
+# Key for one window of a log with one set of parameters
+#
+def resultKey(logHash, i, parameters, slideBy, extent):
+    h = hashlib.sha1()
+    h.update(json.dumps({'version': sweepVersion, 'log': logHash,
+        'window': i, 'slideBy': slideBy, 'extent': extent,
+        'parameters': parameters}, sort_keys=True).encode('utf-8'))
+
+    return h.hexdigest()
+
+#
+# Plain Python value for numpy scalars and one-element arrays, which json
+# can't save
+#
+def jsonValue(value):
+    if isinstance(value, (np.ndarray, np.generic)):
+        return np.ravel(value)[0].item()
+
+    raise TypeError("Can't save %s in the sweep results" % type(value))
+
+#
+# Save a result, written to a temporary file first so an interrupted sweep
+# never leaves a partial result behind
+#
+def saveResult(cacheDir, key, row):
+    filename = os.path.join(cacheDir, key + '.json')
+
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(row, f, default=jsonValue)
+
+    os.replace(filename + '.tmp', filename)
+
+#
+# The saved result, or None if this hasn't been computed yet
+#
+def loadResult(cacheDir, key):
+    filename = os.path.join(cacheDir, key + '.json')
+
+    if not os.path.exists(filename):
+        return None
+
+    with open(filename) as f:
+        return json.load(f)
+
+#
+# Fit one window with one set of parameters, run in a worker process
+#
+def runWindow(log, i, start, extent, parameters):
+    gprParams = GPRParams(theta0=parameters['theta0'], thetaL=1e-10,
+            thetaU=1e10, nugget=parameters['nugget'], random_start=10)
+
+    return fitWindow(log, i, start, parameters['windowLength'],
+            parameters['interval'], gprParams, extent, parameters['points'])
+
+#
+# Run every combination of the values in grid, a dictionary of each of
+# sweepParameters to a list of values, on every sliding window of each log
+#
+# Returns a DataFrame with one row per log, parameters, and window, and how
+# many of those were computed rather than loaded from the cache.
+#
+def sweep(filenames, grid, slideBy=15, extent=0, cacheDir='.cache/sweep',
+        maxWorkers=None):
+    os.makedirs(cacheDir, exist_ok=True)
+
+    rows = []
+    tasks = {}
+
+    with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+        for filename in filenames:
+            # The converted log is cached under the hash of its contents
+            log = loadConvertedLog(filename, hashContents=True)
+            logHash = os.path.basename(log.directory)
+            times = logTimes(log)
+            firstTime, lastTime = times[0], times[-1]
+
+            for values in itertools.product(*(grid[name]
+                    for name in sweepParameters)):
+                parameters = dict(zip(sweepParameters, values))
+                info = dict(parameters, log=filename)
+
+                # Only windows that are entirely in the log
+                slidingWindows = int((lastTime - firstTime -
+                    parameters['windowLength'])//slideBy) + 1
+
+                for i in range(max(slidingWindows, 0)):
+                    key = resultKey(logHash, i, parameters, slideBy, extent)
+                    row = loadResult(cacheDir, key)
+
+                    if row is not None:
+                        rows.append(dict(info, **row))
+                        continue
+
+                    future = executor.submit(runWindow, log, i,
+                            firstTime + slideBy*i, extent, parameters)
+                    tasks[future] = (key, info)
+
+        # Save each result as soon as it's done, so if we're interrupted we
+        # keep what we've computed so far
+        for future in as_completed(tasks):
+            key, info = tasks[future]
+            row = future.result()
+            saveResult(cacheDir, key, row)
+            rows.append(dict(info, **row))
+
+    results = pd.DataFrame(rows)
+
+    if len(results):
+        results = results.sort_values(['log'] + sweepParameters + ['window'])
+        results = results[['log'] + sweepParameters + [c
+            for c in results.columns if c not in sweepParameters + ['log']]]
+
+    return results, len(tasks)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filenames', nargs='+', help="simulator CSV logs")
+    parser.add_argument('--nugget', type=float, nargs='+', default=[1])
+    parser.add_argument('--theta0', type=float, nargs='+', default=[1e-2])
+    parser.add_argument('--window', dest='windowLength', type=float,
+        nargs='+', default=[45], help="sliding window lengths in seconds")
+    parser.add_argument('--interval', type=float, nargs='+', default=[0.4],
+        help="seconds between the samples used in each window")
+    parser.add_argument('--points', type=int, nargs='+', default=[200],
+        help="grid points along each axis")
+    parser.add_argument('--slide', type=float, default=15,
+        help="seconds to slide each window by")
+    parser.add_argument('--cache', default='.cache/sweep',
+        help="directory to save the results of each window in")
+    parser.add_argument('--workers', type=int, default=None,
+        help="number of processes, default is one per core")
+    parser.add_argument('-o', '--output', default='sweep.csv',
+        help="CSV file to save all the results in")
+    args = parser.parse_args()
+
+    grid = dict((name, getattr(args, name)) for name in sweepParameters)
+    results, computed = sweep(args.filenames, grid, args.slide,
+            cacheDir=args.cache, maxWorkers=args.workers)
+    results.to_csv(args.output, index=False)
+
+    print("Computed", computed, "of", len(results), "windows, saved to",
+            args.output)
+
+    # Median over the windows for each log and set of parameters
+    if len(results):
+        print(results.groupby(['log'] + sweepParameters)[['uncertainty',
+            'fitTime']].median().to_string())